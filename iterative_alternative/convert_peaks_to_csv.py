@@ -3,6 +3,10 @@
 import pandas as pd
 import glob
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from functions_Peaks import load_peak_arrays
 
 def convert_peaks_to_csv():
     # Define input and output directories
@@ -46,6 +50,9 @@ def convert_peaks_to_csv():
             # Save to CSV
             df.to_csv(csv_file, index=False)
             print(f"Converted {bed_file} to {csv_file}")
+            
+            # Typed, memory-mappable copy, read back with load_peaks(bed_file, fmt='seacr', cache_dir=output_dir)
+            load_peak_arrays(bed_file, fmt='seacr', cache_dir=output_dir)
 
 if __name__ == "__main__":
     convert_peaks_to_csv()
\ No newline at end of file
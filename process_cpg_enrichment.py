@@ -1,7 +1,14 @@
 import csv
-from operator import itemgetter
+import os
+import sys
 from typing import List, Dict, Tuple
 
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+from functions_Annotation import GeneIndex, load_gene_table
+from functions_Peaks import regions_to_genes
+
 def load_and_filter_cpg(csv_path: str, signal_threshold: float = 0.1) -> List[Dict]:
     """Load and filter CPG enrichment data"""
     filtered_data = []
@@ -23,73 +30,38 @@ def load_and_filter_cpg(csv_path: str, signal_threshold: float = 0.1) -> List[Di
     # Sort by enrichment score in descending order
     return sorted(filtered_data, key=lambda x: x['enrichment'], reverse=True)
 
-def parse_gtf_attributes(attribute_string: str) -> Dict[str, str]:
-    """Parse GTF attribute string into a dictionary"""
-    attributes = {}
-    for attribute in attribute_string.strip().split(';'):
-        if attribute:
-            try:
-                key, value = attribute.strip().split(' ', 1)
-                attributes[key] = value.strip('"')
-            except ValueError:
-                continue
-    return attributes
+def load_gtf(gtf_path: str) -> pd.DataFrame:
+    """Load the genes of a GTF file that have a name and a type (via the cached gene table)"""
+    table = load_gene_table(gtf_path)
+    return table[table['gene_name'].notna() & table['gene_type'].notna()].reset_index(drop=True)
 
-def load_gtf(gtf_path: str) -> List[Dict]:
-    """Load and process GTF file"""
-    genes = []
+def annotate_genomic_regions(cpg_data: List[Dict], genes: pd.DataFrame, max_distance: int = 10000) -> List[str]:
+    """
+    Determine the genomic region of every CPG site: the first overlapping gene,
+    else the nearest gene within max_distance, else intergenic
+    """
+    gene_index = GeneIndex(genes, key_columns=('gene_name', 'gene_id'))
+    regions = pd.DataFrame({
+        'chr': [peak['chr'] for peak in cpg_data],
+        'start': [peak['start'] for peak in cpg_data],
+        'end': [peak['end'] for peak in cpg_data]
+    })
     
-    with open(gtf_path, 'r') as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-                
-            fields = line.strip().split('\t')
-            if len(fields) < 9 or fields[2] != 'gene':
-                continue
-                
-            attributes = parse_gtf_attributes(fields[8])
-            if 'gene_name' not in attributes or 'gene_type' not in attributes:
-                continue
-                
-            genes.append({
-                'seqname': fields[0],
-                'start': int(fields[3]),
-                'end': int(fields[4]),
-                'gene_name': attributes['gene_name'],
-                'gene_type': attributes['gene_type']
-            })
-    
-    return genes
-
-def determine_genomic_region(peak: Dict, genes: List[Dict]) -> str:
-    """Determine the genomic region for a given CPG site"""
-    chr_genes = [g for g in genes if g['seqname'] == peak['chr']]
-    
-    # Check if the peak overlaps with any gene
-    for gene in chr_genes:
-        if (peak['start'] <= gene['end'] and peak['end'] >= gene['start']):
-            return f"{gene['gene_name']} ({gene['gene_type']})"
-    
-    # If no overlap found, find nearest gene
-    distances = []
-    for gene in chr_genes:
-        if peak['start'] > gene['end']:
-            distance = peak['start'] - gene['end']
-        elif peak['end'] < gene['start']:
-            distance = gene['start'] - peak['end']
-        else:
-            distance = 0
-        distances.append((distance, gene['gene_name'], gene['gene_type']))
+    # All genes within max_distance of every site, from one interval join;
+    # per site keep the closest gene (overlaps first, ties in GTF order)
+    region_genes = regions_to_genes(regions, gene_index, flank=max_distance)
+    nearest = region_genes.sort_values(['region', 'distance', 'gene'], kind='stable').drop_duplicates('region')
     
-    if distances:
-        min_distance, nearest_gene, gene_type = min(distances, key=itemgetter(0))
-        if min_distance > 10000:  # More than 10kb away
-            return "Intergenic"
+    gene_types = genes['gene_type'].to_numpy()
+    labels = ["Intergenic"] * len(cpg_data)
+    for region, gene, gene_name, distance in zip(nearest['region'], nearest['gene'],
+                                                 nearest['gene_name'], nearest['distance']):
+        if distance == 0:
+            labels[region] = f"{gene_name} ({gene_types[gene]})"
         else:
-            return f"Near {nearest_gene} ({gene_type}), {min_distance}bp"
+            labels[region] = f"Near {gene_name} ({gene_types[gene]}), {distance}bp"
     
-    return "Intergenic"
+    return labels
 
 def write_results(data: List[Dict], output_file: str):
     """Write results to CSV file"""
@@ -118,8 +90,8 @@ def main():
     
     # Add genomic region annotation
     print("Annotating genomic regions...")
-    for peak in cpg_data:
-        peak['genomic_region'] = determine_genomic_region(peak, genes)
+    for peak, genomic_region in zip(cpg_data, annotate_genomic_regions(cpg_data, genes)):
+        peak['genomic_region'] = genomic_region
     
     # Save results
     output_file = "cpg_enrichment_annotated.csv"
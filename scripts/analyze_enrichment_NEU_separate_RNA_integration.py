@@ -5,16 +5,24 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import pybedtools
 import os
-import pysam
 import time
 from pybedtools import BedTool
+from functions_Annotation import (DEAIndex, GeneIndex, load_dea, load_gene_table,
+                                  resolve_dea_genes, standardize_gene_name, standardize_gene_names)
+from functions_Depth import sequencing_depth
+from functions_Enrichment import (neg_log10_qvalue_clipped, permutation_pvalues, region_enrichment,
+                                  region_expression_chunks, score_promoter_windows, score_promoters,
+                                  verify_enrichment_scores)
+from functions_Peaks import (as_peak_set, build_peak_sets, gene_peak_coordinates,
+                             gene_peak_membership, load_peaks, load_samples, split_by_gene,
+                             with_peak_coordinates)
 
 PROMOTER_WINDOW = 2000  # Define promoter region as ±2kb from TSS
 
 # Set working directory
 import argparse
 
-# Parse command line arguments
+# Command line arguments (parsed under __main__)
 parser = argparse.ArgumentParser(description='Analyze enrichment for NSC samples')
 parser.add_argument('--working-dir', type=str, required=True,
                    help='Path to working directory')
@@ -22,25 +30,34 @@ parser.add_argument('--data-dir', type=str, required=True,
                    help='Path to data directory')
 parser.add_argument('--results-dir', type=str, required=True,
                    help='Path to results directory')
-args = parser.parse_args()
-
-os.chdir(args.working_dir)
-
-DATA_DIR = args.data_dir
-RESULTS_DIR = args.results_dir
+parser.add_argument('--workers', type=int, default=6,
+                   help='Number of parallel workers (sample loading, scoring, permutations, CpG signal)')
+parser.add_argument('--verify-scores', action='store_true',
+                   help='Check the columnar enrichment scores against the per-gene method lambdas')
+parser.add_argument('--score-all-genes', action='store_true',
+                   help='Score every DEA gene (not only up-regulated ones) in the enrichment_scores table')
+parser.add_argument('--permutations', type=int, default=0,
+                   help='Number of peak shuffles for empirical p-values (0 to skip)')
+parser.add_argument('--permutation-seed', type=int, default=0,
+                   help='Random seed of the peak shuffles')
+parser.add_argument('--chrom-sizes', type=str, default=None,
+                   help='Genome size file bounding the peak shuffles')
+parser.add_argument('--shuffle-exclude', type=str, default=None,
+                   help='BED of regions shuffled peaks must avoid (e.g. assembly gaps)')
+parser.add_argument('--shuffle-bins', type=str, default=None,
+                   help='BED of matched bins (4th column: GC/CpG class) for the peak shuffles')
+parser.add_argument('--promoter-windows', type=int, nargs='+', default=None,
+                   help='Promoter half-widths (bp) to sweep in one pass, e.g. 500 1000 2000 5000 10000')
+parser.add_argument('--no-peak-coordinates', action='store_true',
+                   help='Leave the chr:start-end peak lists out of the per-method CSVs (see enrichment_peaks)')
 
 # Add function to calculate sequencing depth
 def calculate_sequencing_depth(bam_file):
     """Calculate total mapped reads from BAM file"""
-    with pysam.AlignmentFile(bam_file, "rb") as bam:
-        return bam.count()
+    return sequencing_depth(bam_file)
 
 def load_data():
     try:
-        # Load DEA results
-        dea_nsc = pd.read_csv("../DATA/DEA_NSC.csv")
-        print("\nDEA file columns:", dea_nsc.columns.tolist())
-        
         # Add timeout for file operations
         def load_with_timeout(filepath, timeout=30):
             """Load file with timeout"""
@@ -82,10 +99,8 @@ def load_data():
                 return pd.DataFrame()
             
             try:
-                df = pd.read_csv(filepath, sep='\t', header=None,
-                               names=['chr', 'start', 'end', 'name', 'score',
-                                     'strand', 'signalValue', 'pValue',
-                                     'qValue', 'peak'])
+                # Typed narrowPeak columns from the binary peak cache
+                df = load_peaks(filepath)
                 return validate_peak_file(df, sample_name)
             except Exception as e:
                 print(f"Error loading peak file {filepath}: {str(e)}")
@@ -98,11 +113,8 @@ def load_data():
                     print(f"Warning: BAM file not found: {bam_file}")
                     return 1
                 
-                with pysam.AlignmentFile(bam_file, "rb") as bam:
-                    if not bam.check_index():
-                        print(f"Warning: BAM index missing for {bam_file}")
-                        return 1
-                    return max(bam.count(), 1)  # Ensure non-zero return
+                # Index statistics, cached in a sidecar next to the BAM
+                return max(sequencing_depth(bam_file), 1)  # Ensure non-zero return
             except Exception as e:
                 print(f"Error calculating depth for {bam_file}: {str(e)}")
                 return 1
@@ -111,28 +123,19 @@ def load_data():
         exo_samples = ['NSCv1', 'NSCv2', 'NSCv3']
         endo_samples = ['NSCM1', 'NSCM2', 'NSCM3']
         
-        peaks_exo = {}
-        peaks_endo = {}
-        depths_exo = {}
-        depths_endo = {}
-        
-        # Load exogenous samples
-        for sample in exo_samples:
-            peak_file = f"{RESULTS_DIR}/peaks/{sample}_peaks.narrowPeak"
-            peaks_exo[sample] = load_peak_file(peak_file, sample)
-            depths_exo[sample] = calculate_sequencing_depth_safe(f"{DATA_DIR}/aligned/{sample}.bam")
+        def load_sample(sample):
+            """Peaks of one sample with signal normalized by its sequencing depth"""
+            peaks = load_peak_file(f"{RESULTS_DIR}/peaks/{sample}_peaks.narrowPeak", sample)
+            depth = calculate_sequencing_depth_safe(f"{DATA_DIR}/aligned/{sample}.bam")
             
-            if not peaks_exo[sample].empty:
-                peaks_exo[sample]['signalValue'] = peaks_exo[sample]['signalValue'].clip(lower=0) * (1e6 / depths_exo[sample])
+            if not peaks.empty:
+                peaks['signalValue'] = peaks['signalValue'].clip(lower=0) * (1e6 / depth)
+            return peaks
         
-        # Load endogenous samples
-        for sample in endo_samples:
-            peak_file = f"{RESULTS_DIR}/peaks/{sample}_peaks.narrowPeak"
-            peaks_endo[sample] = load_peak_file(peak_file, sample)
-            depths_endo[sample] = calculate_sequencing_depth_safe(f"{DATA_DIR}/aligned/{sample}.bam")
-            
-            if not peaks_endo[sample].empty:
-                peaks_endo[sample]['signalValue'] = peaks_endo[sample]['signalValue'].clip(lower=0) * (1e6 / depths_endo[sample])
+        # Load exogenous and endogenous samples concurrently
+        peaks_all = load_samples(exo_samples + endo_samples, load_sample, max_workers=LOAD_WORKERS)
+        peaks_exo = {sample: peaks_all[sample] for sample in exo_samples}
+        peaks_endo = {sample: peaks_all[sample] for sample in endo_samples}
         
         # Validate we have usable data
         if all(df.empty for df in peaks_exo.values()) or all(df.empty for df in peaks_endo.values()):
@@ -140,33 +143,18 @@ def load_data():
             raise ValueError("Insufficient peak data for analysis")
 
         # Load gene annotations
-        gene_annotations, name_to_info = load_gene_annotations()
+        gene_annotations, gene_index = load_gene_annotations()
         
-        return dea_nsc, peaks_exo, peaks_endo, gene_annotations, name_to_info
+        # Load DEA results, identifiers resolved against the annotation (cached per file)
+        dea_nsc = load_dea("../DATA/DEA_NSC.csv", gene_index)
+        print("\nDEA file columns:", dea_nsc.columns.tolist())
+        
+        return dea_nsc, peaks_exo, peaks_endo, gene_annotations, gene_index
         
     except Exception as e:
         print(f"Error in load_data: {str(e)}")
         raise
 
-def standardize_gene_name(gene_name):
-    """Standardize gene names to match between DEA and GTF"""
-    if pd.isna(gene_name):
-        return None
-    
-    # Convert to string if not already
-    gene_name = str(gene_name)
-    
-    # Remove version numbers if present (e.g., Gene.1 -> Gene)
-    gene_name = gene_name.split('.')[0]
-    
-    # Remove common prefixes/suffixes that might differ between annotations
-    prefixes = ['gene-', 'Gene-', 'GENE-']
-    for prefix in prefixes:
-        if gene_name.startswith(prefix):
-            gene_name = gene_name[len(prefix):]
-    
-    return gene_name.strip()
-
 def load_gene_annotations():
     """Load gene annotations from GTF file and extract gene names"""
     print("Loading gene annotations...")
@@ -175,74 +163,39 @@ def load_gene_annotations():
     if not os.path.exists(gtf_file):
         raise FileNotFoundError(f"GTF file not found: {gtf_file}")
     
-    gene_annotations = pd.read_csv(gtf_file, sep='\t', comment='#',
-                                 names=['chr', 'source', 'feature', 'start', 'end',
-                                       'score', 'strand', 'frame', 'attributes'])
-    
-    # Filter for genes only
-    gene_annotations = gene_annotations[gene_annotations['feature'] == 'gene']
-    
-    def extract_gene_info(attr):
-        info = {}
-        for field in attr.split(';'):
-            field = field.strip()
-            if field.startswith('gene_name'):
-                info['gene_name'] = field.split('"')[1]
-            elif field.startswith('gene_id'):
-                info['gene_id'] = field.split('"')[1]
-            elif field.startswith('gene_type'):
-                info['gene_type'] = field.split('"')[1]
-        return pd.Series(info)
-    
-    # Extract gene information
-    gene_info = gene_annotations['attributes'].apply(extract_gene_info)
-    gene_annotations = pd.concat([gene_annotations, gene_info], axis=1)
+    # Gene table (gene_id, gene_name, gene_type, chr, start, end, strand) is cached next to the GTF
+    gene_annotations = load_gene_table(gtf_file)
     
     # Create standardized versions of gene names and IDs
-    gene_annotations['gene_name_std'] = gene_annotations['gene_name'].apply(standardize_gene_name)
-    gene_annotations['gene_id_std'] = gene_annotations['gene_id'].apply(standardize_gene_name)
+    gene_annotations['gene_name_std'] = standardize_gene_names(gene_annotations['gene_name'])
+    gene_annotations['gene_id_std'] = standardize_gene_names(gene_annotations['gene_id'])
     
-    # Create a mapping dictionary for quick lookups
-    name_to_info = {}
-    for _, row in gene_annotations.iterrows():
-        if not pd.isna(row['gene_name']):
-            name_to_info[standardize_gene_name(row['gene_name'])] = row
-        if not pd.isna(row['gene_id']):
-            name_to_info[standardize_gene_name(row['gene_id'])] = row
+    # Compact lookup: standardized name/id -> row, coordinates as typed arrays
+    gene_index = GeneIndex(gene_annotations)
     
     print(f"Loaded {len(gene_annotations)} genes from GTF")
-    print(f"Created mapping for {len(name_to_info)} unique gene identifiers")
+    print(f"Created mapping for {len(gene_index)} unique gene identifiers")
     
-    return gene_annotations, name_to_info
+    return gene_annotations, gene_index
 
-def get_peaks_near_gene(gene, peaks_dict, gene_annotations, name_to_info, window=PROMOTER_WINDOW):
+def get_peaks_near_gene(gene, peaks_dict, gene_annotations, gene_index, window=PROMOTER_WINDOW):
     """Get peaks near a gene's promoter region"""
     gene_std = standardize_gene_name(gene)
     
-    if gene_std not in name_to_info:
+    if gene_std not in gene_index:
         return pd.DataFrame()
     
-    gene_info = name_to_info[gene_std]
+    row = gene_index.lookup(gene_std)
+    chrom = gene_index.chromosomes(row)
     
-    # Create promoter region (TSS ± window)
-    if gene_info['strand'] == '+':
-        promoter_start = max(0, gene_info['start'] - window)
-        promoter_end = gene_info['start'] + window
-    else:
-        promoter_start = max(0, gene_info['end'] - window)
-        promoter_end = gene_info['end'] + window
+    # Promoter region (TSS ± window), strand-aware and precomputed for all genes
+    promoter_start, promoter_end = gene_index.promoters.region(row, window)
     
     # Collect overlapping peaks from all samples
     all_peaks = []
     for sample, peaks in peaks_dict.items():
-        # Filter peaks for the same chromosome first
-        chr_peaks = peaks[peaks['chr'] == gene_info['chr']]
-        
-        # Find overlapping peaks
-        overlapping = chr_peaks.loc[
-            (chr_peaks['start'] <= promoter_end) & 
-            (chr_peaks['end'] >= promoter_start)
-        ].copy()  # Create explicit copy
+        # Overlapping peaks by binary search on the chromosome-sorted peak set
+        overlapping = as_peak_set(peaks).overlapping(chrom, promoter_start, promoter_end).copy()
         
         if not overlapping.empty:
             overlapping.loc[:, 'sample'] = sample
@@ -330,25 +283,23 @@ def define_enrichment_methods(total_genome_peaks):
     
     return methods
 
-def analyze_enrichment(dea, peaks_exo, peaks_endo, gene_annotations, name_to_info):
+def analyze_enrichment(dea, peaks_exo, peaks_endo, gene_annotations, gene_index):
     # Load data
     # print("Loading data...")
-    # dea, peaks_exo, peaks_endo, gene_annotations, name_to_info = load_data()
+    # dea, peaks_exo, peaks_endo, gene_annotations, gene_index = load_data()
     
     # Print diagnostic information
     print(f"\nDiagnostic information:")
     print(f"DEA genes: {len(dea)}")
     print(f"Annotation genes: {len(gene_annotations)}")
     
-    # Standardize DEA gene names
-    dea['gene_std'] = dea['gene'].apply(standardize_gene_name)
+    # Standardize and resolve DEA gene names (already done if loaded with load_dea)
+    resolve_dea_genes(dea, gene_index)
     
-    # Define up-regulated genes (log2FC > 1 and padj < 0.05)
-    upreg_genes = dea[
-        (dea['log2FoldChange'] > 0.5) & 
-        (dea['padj'] < 0.05) &
-        (dea['gene_std'].notna())
-    ]['gene_std'].tolist()
+    # DEA keyed by standardized name, expression categories assigned once;
+    # up-regulated genes: log2FC > 0.5 and padj < 0.05
+    dea_index = DEAIndex(dea, log2fc_threshold=0.5, padj_threshold=0.05)
+    upreg_genes = dea_index.genes('up-regulated')
     
     print(f"Up-regulated genes: {len(upreg_genes)}")
     
@@ -356,51 +307,69 @@ def analyze_enrichment(dea, peaks_exo, peaks_endo, gene_annotations, name_to_inf
     total_genome_peaks = calculate_total_genome_peaks(peaks_exo, peaks_endo)
     print(f"Total genome peaks: {total_genome_peaks}")
     
-    # Calculate enrichment
+    # Chromosome-sorted peak sets, built once for all genes and methods
+    peak_sets_exo = build_peak_sets(peaks_exo)
+    peak_sets_endo = build_peak_sets(peaks_endo)
+    
+    # Promoter x peak overlaps of all up-regulated genes (every DEA gene with
+    # --score-all-genes), computed once for all methods
+    upreg_rows = gene_index.lookup_many(standardize_gene_names(upreg_genes))
+    if SCORE_ALL_GENES:
+        score_rows = gene_index.lookup_many(standardize_gene_names(dea['gene_std']))
+    else:
+        score_rows = upreg_rows
+    
+    # Calculate enrichment: joins and every method for every gene in one columnar
+    # pass, over chunks of genes in LOAD_WORKERS processes
     methods = define_enrichment_methods(total_genome_peaks)
+    scores, exo_promoter_peaks, endo_promoter_peaks = score_promoters(
+        gene_index, score_rows, peak_sets_exo, peak_sets_endo, PROMOTER_WINDOW, total_genome_peaks,
+        qvalue_weight=neg_log10_qvalue_clipped, max_workers=LOAD_WORKERS)
+    exo_near_genes = split_by_gene(exo_promoter_peaks)
+    endo_near_genes = split_by_gene(endo_promoter_peaks)
+    if VERIFY_SCORES:
+        verify_enrichment_scores(scores, exo_near_genes, endo_near_genes, methods)
+    if N_PERMUTATIONS:
+        empirical = permutation_pvalues(scores, peaks_exo, peaks_endo, gene_index, PROMOTER_WINDOW,
+                                        total_genome_peaks, n_permutations=N_PERMUTATIONS,
+                                        seed=PERMUTATION_SEED, qvalue_weight=neg_log10_qvalue_clipped,
+                                        chrom_sizes=args.chrom_sizes, excluded=args.shuffle_exclude,
+                                        bins=args.shuffle_bins, max_workers=LOAD_WORKERS)
+        scores = scores.join(empirical.add_suffix('_empirical_p'))
+    
+    # DEA values of the up-regulated genes, looked up once for all methods
+    upreg_dea = dea_index.take(upreg_genes, ['log2FoldChange', 'padj'])
+    upreg_log2fc = upreg_dea['log2FoldChange'].to_numpy()
+    upreg_padj = upreg_dea['padj'].to_numpy()
     results = {}
     
-    for method_name, method_func in methods.items():
+    for method_name in methods:
         print(f"\nProcessing method: {method_name}")
         enrichment_scores = []
         peaks_found = 0
         
-        for i, gene in enumerate(upreg_genes, 1):
+        for i, (gene, gene_row) in enumerate(zip(upreg_genes, upreg_rows), 1):
             if i % 100 == 0:
                 print(f"Processing gene {i}/{len(upreg_genes)}")
             
             try:
-                exo_peaks = get_peaks_near_gene(gene, peaks_exo, gene_annotations, name_to_info)
-                endo_peaks = get_peaks_near_gene(gene, peaks_endo, gene_annotations, name_to_info)
+                exo_peaks = exo_near_genes.get(gene_row, pd.DataFrame())
+                endo_peaks = endo_near_genes.get(gene_row, pd.DataFrame())
                 
                 if not exo_peaks.empty or not endo_peaks.empty:
                     peaks_found += 1
-                    score = method_func(exo_peaks, endo_peaks)
-                    
-                    # Get DEA information for this gene
-                    dea_info = dea[dea['gene_std'] == gene].iloc[0]
+                    score = scores.at[gene_row, method_name]
                     
                     if not np.isnan(score):
-                        # Create peak coordinate strings
-                        exo_coords = []
-                        if not exo_peaks.empty:
-                            exo_coords = [f"{row['chr']}:{row['start']}-{row['end']}" 
-                                        for _, row in exo_peaks.iterrows()]
-                        
-                        endo_coords = []
-                        if not endo_peaks.empty:
-                            endo_coords = [f"{row['chr']}:{row['start']}-{row['end']}" 
-                                         for _, row in endo_peaks.iterrows()]
-                        
+                        # Peak membership by gene row; coordinate strings are rendered at export
                         enrichment_scores.append({
                             'gene': gene,
+                            'gene_row': gene_row,
                             'enrichment_score': score,
-                            'log2FoldChange': dea_info['log2FoldChange'],
-                            'padj': dea_info['padj'],
-                            'exo_peaks': ';'.join(exo_coords) if exo_coords else 'None',
-                            'endo_peaks': ';'.join(endo_coords) if endo_coords else 'None',
-                            'num_exo_peaks': len(exo_coords),
-                            'num_endo_peaks': len(endo_coords)
+                            'log2FoldChange': upreg_log2fc[i - 1],
+                            'padj': upreg_padj[i - 1],
+                            'num_exo_peaks': len(exo_peaks),
+                            'num_endo_peaks': len(endo_peaks)
                         })
                 
             except Exception as e:
@@ -413,11 +382,37 @@ def analyze_enrichment(dea, peaks_exo, peaks_endo, gene_annotations, name_to_inf
         if enrichment_scores:
             results[method_name] = pd.DataFrame(enrichment_scores)
     
+    # Gene-peak membership of every scored gene, written once for all methods
+    gene_peak_membership({'exo': exo_promoter_peaks, 'endo': endo_promoter_peaks},
+                         gene_index.gene_name).to_csv(f'{RESULTS_DIR}/enrichment_peaks_NSC.csv', index=False)
+    
+    # Coordinate strings, rendered once per gene and shared by the per-method exports
+    exo_coordinates = endo_coordinates = None
+    if PEAK_COORDINATES:
+        exo_coordinates = gene_peak_coordinates(exo_promoter_peaks)
+        endo_coordinates = gene_peak_coordinates(endo_promoter_peaks)
+    
     # Save detailed results to CSV
     for method_name, df in results.items():
         # Sort by enrichment score in descending order
         df_sorted = df.sort_values('enrichment_score', ascending=False)
-        df_sorted.to_csv(f'{RESULTS_DIR}/enrichment_{method_name}_NSC.csv', index=False)
+        with_peak_coordinates(df_sorted, exo_coordinates, endo_coordinates).to_csv(
+            f'{RESULTS_DIR}/enrichment_{method_name}_NSC.csv', index=False)
+    
+    # All methods side by side, one column per method, with BH q-values of the Fisher test
+    scores.set_index(pd.Index(gene_index.gene_name[scores.index], name='gene')).to_csv(
+        f'{RESULTS_DIR}/enrichment_scores_NSC.csv')
+    
+    # Promoter window sweep: one join at the largest window, smaller windows by
+    # thresholding each peak's distance to the TSS (window x gene x method)
+    if PROMOTER_WINDOWS:
+        sweep = score_promoter_windows(gene_index, score_rows, peak_sets_exo, peak_sets_endo,
+                                       PROMOTER_WINDOWS, total_genome_peaks,
+                                       qvalue_weight=neg_log10_qvalue_clipped)
+        sweep.index = pd.MultiIndex.from_arrays(
+            [sweep.index.get_level_values('window'),
+             gene_index.gene_name[sweep.index.get_level_values('gene')]], names=['window', 'gene'])
+        sweep.to_csv(f'{RESULTS_DIR}/enrichment_window_sweep_NSC.csv')
     
     return results
 
@@ -465,12 +460,12 @@ def summarize_results(results):
     summary_df.to_csv(f'{DATA_DIR}/enrichment_summary_NSC.csv')
     return summary_df
 
-def print_gene_name_examples(dea, name_to_info):
+def print_gene_name_examples(dea, gene_index):
     """Print examples of gene name matching"""
     print("\nGene name matching examples:")
     for gene in dea['gene'].head(10):
         std_name = standardize_gene_name(gene)
-        found = std_name in name_to_info
+        found = std_name in gene_index
         print(f"Original: {gene:20} Standardized: {std_name:20} Found: {found}")
 
 def plot_peak_width_distributions(peaks_exo, peaks_endo):
@@ -558,15 +553,18 @@ def plot_detailed_peak_width_distributions(peaks_exo, peaks_endo):
     plt.savefig(f'{RESULTS_DIR}/peak_width_distributions_detailed.pdf')
     plt.close()
 
-def plot_width_vs_enrichment(results, peaks_exo, peaks_endo, gene_annotations, name_to_info):
+def plot_width_vs_enrichment(results, peaks_exo, peaks_endo, gene_annotations, gene_index):
     """Plot relationship between peak widths and enrichment scores"""
     plt.figure(figsize=(15, 5))
     
+    peak_sets_exo = build_peak_sets(peaks_exo)
+    peak_sets_endo = build_peak_sets(peaks_endo)
+    
     # Calculate mean peak widths for each gene
     width_ratios = {}
     for gene in results['width_weighted']['gene']:
-        exo_peaks = get_peaks_near_gene(gene, peaks_exo, gene_annotations, name_to_info)
-        endo_peaks = get_peaks_near_gene(gene, peaks_endo, gene_annotations, name_to_info)
+        exo_peaks = get_peaks_near_gene(gene, peak_sets_exo, gene_annotations, gene_index)
+        endo_peaks = get_peaks_near_gene(gene, peak_sets_endo, gene_annotations, gene_index)
         
         if not exo_peaks.empty and not endo_peaks.empty:
             mean_width_exo = (exo_peaks['end'] - exo_peaks['start']).mean()
@@ -639,63 +637,14 @@ def load_cpg_islands():
 def analyze_cpg_enrichment(peaks_exo, peaks_endo, cpg_islands):
     """Analyze enrichment of peaks in CpG islands"""
     print("\nAnalyzing CpG island enrichment...")
+    start_time = time.perf_counter()
     
-    # Convert dataframes to BedTool objects
-    cpg_bed = BedTool.from_dataframe(cpg_islands[['chr', 'start', 'end']])
-    
-    results = {}
-    for sample, peaks in peaks_exo.items():
-        peaks_bed = BedTool.from_dataframe(peaks[['chr', 'start', 'end', 'signalValue']])
-        intersect = peaks_bed.intersect(cpg_bed, wa=True, wb=True)
-        results[f"{sample}_cpg"] = pd.DataFrame(intersect)
-    
-    for sample, peaks in peaks_endo.items():
-        peaks_bed = BedTool.from_dataframe(peaks[['chr', 'start', 'end', 'signalValue']])
-        intersect = peaks_bed.intersect(cpg_bed, wa=True, wb=True)
-        results[f"{sample}_cpg"] = pd.DataFrame(intersect)
-    
-    # Calculate enrichment metrics for each CpG island
-    cpg_enrichment = []
-    
-    for _, cpg in cpg_islands.iterrows():
-        exo_signal = 0
-        endo_signal = 0
-        
-        # Sum signals for exo samples
-        for sample in peaks_exo.keys():
-            if f"{sample}_cpg" in results:
-                sample_peaks = results[f"{sample}_cpg"]
-                mask = (sample_peaks[7] == cpg['chr']) & \
-                       (sample_peaks[8] == cpg['start']) & \
-                       (sample_peaks[9] == cpg['end'])
-                if not sample_peaks[mask].empty:
-                    exo_signal += sample_peaks[mask][3].sum()  # signalValue
-        
-        # Sum signals for endo samples
-        for sample in peaks_endo.keys():
-            if f"{sample}_cpg" in results:
-                sample_peaks = results[f"{sample}_cpg"]
-                mask = (sample_peaks[7] == cpg['chr']) & \
-                       (sample_peaks[8] == cpg['start']) & \
-                       (sample_peaks[9] == cpg['end'])
-                if not sample_peaks[mask].empty:
-                    endo_signal += sample_peaks[mask][3].sum()  # signalValue
-        
-        # Calculate enrichment
-        enrichment = exo_signal / max(endo_signal, 1)  # Prevent division by zero
-        
-        cpg_enrichment.append({
-            'chr': cpg['chr'],
-            'start': cpg['start'],
-            'end': cpg['end'],
-            'exo_signal': exo_signal,
-            'endo_signal': endo_signal,
-            'enrichment': enrichment
-        })
-    
-    enrichment_df = pd.DataFrame(cpg_enrichment)
+    # Islands x peaks of all samples in one interval join per condition (BED
+    # overlap rules, as bedtools intersect), signalValue summed per island
+    enrichment_df = region_enrichment(cpg_islands, peaks_exo, peaks_endo, max_workers=LOAD_WORKERS)
     enrichment_df.to_csv(f'{RESULTS_DIR}/cpg_enrichment_NSC.csv', index=False)
     
+    print(f"Aggregated signal of {len(enrichment_df)} CpG islands ({time.perf_counter() - start_time:.1f}s)")
     return enrichment_df
 
 def plot_cpg_enrichment(enrichment_df):
@@ -719,88 +668,85 @@ def plot_cpg_enrichment(enrichment_df):
     plt.close()
 
 def integrate_with_rna_seq(enrichment_df, dea_nsc, gene_annotations):
-    """Integrate CpG enrichment with RNA-seq data"""
-    print("\nIntegrating CpG enrichment with RNA-seq data...")
-    
-    # Create BedTool objects
-    cpg_bed = BedTool.from_dataframe(
-        enrichment_df[['chr', 'start', 'end']]
-    )
-    genes_bed = BedTool.from_dataframe(
-        gene_annotations[['chr', 'start', 'end', 'gene_name']]
-    )
-    
-    # Find overlaps between CpG islands and genes
-    overlaps = cpg_bed.intersect(genes_bed, wa=True, wb=True)
-    
-    # Create integrated dataset
-    integrated_data = []
-    for overlap in overlaps:
-        cpg_idx = enrichment_df[
-            (enrichment_df['chr'] == overlap[0]) & 
-            (enrichment_df['start'] == int(overlap[1])) & 
-            (enrichment_df['end'] == int(overlap[2]))
-        ].index[0]
-        
-        gene_name = overlap[7]
-        if gene_name in dea_nsc['gene'].values:
-            dea_info = dea_nsc[dea_nsc['gene'] == gene_name].iloc[0]
-            
-            integrated_data.append({
-                'chr': overlap[0],
-                'cpg_start': int(overlap[1]),
-                'cpg_end': int(overlap[2]),
-                'gene': gene_name,
-                'enrichment': enrichment_df.loc[cpg_idx, 'enrichment'],
-                'log2FoldChange': dea_info['log2FoldChange'],
-                'padj': dea_info['padj']
-            })
-    
-    integrated_df = pd.DataFrame(integrated_data)
-    integrated_df.to_csv(f'{RESULTS_DIR}/cpg_rna_integrated_NSC.csv', index=False)
-    
-    return integrated_df
+    """
+    Integrate CpG enrichment with RNA-seq data.
 
-# if __name__ == "__main__":
-# Create output directory if it doesn't exist
-os.makedirs('results', exist_ok=True)
+    CpG islands are joined with the genes they overlap and with the DEA of
+    those genes (region_expression_chunks); blocks of islands are appended to
+    the CSV as they are joined, so the full table is never held in memory.
 
-# Load data
-dea, peaks_exo, peaks_endo, gene_annotations, name_to_info = load_data()
+    Returns:
+        int: Number of integrated (island, gene) rows written
+    """
+    print("\nIntegrating CpG enrichment with RNA-seq data...")
+    
+    # DEA keyed by gene name: one batched lookup per block of overlaps
+    dea_index = DEAIndex(dea_nsc, key_column='gene')
+    
+    output_file = f'{RESULTS_DIR}/cpg_rna_integrated_NSC.csv'
+    carried = ['enrichment']
+    header = ['chr', 'cpg_start', 'cpg_end', 'gene', *carried, 'log2FoldChange', 'padj']
+    pd.DataFrame(columns=header).to_csv(output_file, index=False)
+    
+    n_integrated = 0
+    for block in region_expression_chunks(enrichment_df, gene_annotations, dea_index, carried):
+        block = block.rename(columns={'start': 'cpg_start', 'end': 'cpg_end'})
+        block.to_csv(output_file, mode='a', header=False, index=False)
+        n_integrated += len(block)
+    print(f"Integrated {n_integrated} CpG island-gene pairs with gene expression data")
+    return n_integrated
+
+if __name__ == "__main__":
+    # Parse command line arguments
+    args = parser.parse_args()
+
+    os.chdir(args.working_dir)
+
+    DATA_DIR = args.data_dir
+    LOAD_WORKERS = args.workers
+    VERIFY_SCORES = args.verify_scores
+    SCORE_ALL_GENES = args.score_all_genes
+    N_PERMUTATIONS = args.permutations
+    PERMUTATION_SEED = args.permutation_seed
+    PROMOTER_WINDOWS = args.promoter_windows
+    PEAK_COORDINATES = not args.no_peak_coordinates
+    RESULTS_DIR = args.results_dir
+
+    # Create output directory if it doesn't exist
+    os.makedirs('results', exist_ok=True)
 
-# Load CpG islands
-cpg_islands = load_cpg_islands()
+    # Load data
+    dea, peaks_exo, peaks_endo, gene_annotations, gene_index = load_data()
 
-# Analyze CpG enrichment
-enrichment_df = analyze_cpg_enrichment(peaks_exo, peaks_endo, cpg_islands)
+    # Load CpG islands
+    cpg_islands = load_cpg_islands()
 
-# Create visualizations
-plot_cpg_enrichment(enrichment_df)
+    # Analyze CpG enrichment
+    enrichment_df = analyze_cpg_enrichment(peaks_exo, peaks_endo, cpg_islands)
 
-# Integrate with RNA-seq data
-integrated_df = integrate_with_rna_seq(enrichment_df, dea, gene_annotations)
+    # Create visualizations
+    plot_cpg_enrichment(enrichment_df)
 
-# Plot peak width distributions
-plot_peak_width_distributions(peaks_exo, peaks_endo)
-plot_detailed_peak_width_distributions(peaks_exo, peaks_endo)
+    # Integrate with RNA-seq data
+    n_integrated = integrate_with_rna_seq(enrichment_df, dea, gene_annotations)
 
-# Run analysis
-results = analyze_enrichment(dea, peaks_exo, peaks_endo, gene_annotations, name_to_info)
+    # Plot peak width distributions
+    plot_peak_width_distributions(peaks_exo, peaks_endo)
+    plot_detailed_peak_width_distributions(peaks_exo, peaks_endo)
 
-# Create visualizations
-plot_enrichment(results)
+    # Run analysis
+    results = analyze_enrichment(dea, peaks_exo, peaks_endo, gene_annotations, gene_index)
 
-# Generate summary statistics
-summarize_results(results)
+    # Create visualizations
+    plot_enrichment(results)
 
-# Save detailed results to CSV
-for method_name, df in results.items():
-    df.to_csv(f'{RESULTS_DIR}/enrichment_{method_name}_NSC.csv', index=False) 
+    # Generate summary statistics
+    summarize_results(results)
 
-# Plot width vs enrichment
-plot_width_vs_enrichment(results, peaks_exo, peaks_endo, gene_annotations, name_to_info)
+    # Plot width vs enrichment
+    plot_width_vs_enrichment(results, peaks_exo, peaks_endo, gene_annotations, gene_index)
 
-# Summarize peak distribution
-peak_distribution = summarize_peak_distribution(results)
-print("\nPeak Distribution Summary:")
-print(peak_distribution)
+    # Summarize peak distribution
+    peak_distribution = summarize_peak_distribution(results)
+    print("\nPeak Distribution Summary:")
+    print(peak_distribution)
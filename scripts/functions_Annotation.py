@@ -0,0 +1,619 @@
+# Standard library imports
+import glob
+import gzip
+import hashlib
+import json
+import os
+from functools import lru_cache
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+GTF_COLUMNS = ['chr', 'source', 'feature', 'start', 'end',
+               'score', 'strand', 'frame', 'attributes']
+
+# Attributes parsed from column 9 of gene records
+GENE_ATTRIBUTES = ['gene_id', 'gene_name', 'gene_type']
+
+# Columns kept in the cached gene table, in order
+GENE_TABLE_COLUMNS = ['gene_id', 'gene_name', 'gene_type', 'chr', 'start', 'end', 'strand']
+
+# Bump when the layout of the cached table changes so old caches are ignored
+ANNOTATION_CACHE_VERSION = 1
+
+# Prefixes stripped from gene identifiers before matching DEA and GTF names
+GENE_NAME_PREFIXES = ['gene-', 'Gene-', 'GENE-']
+
+# Expression categories of DEA genes, in reporting order
+EXPRESSION_CATEGORIES = ['non-deregulated', 'up-regulated', 'down-regulated']
+
+
+######################## GTF parsing ########################################################################################################################################################################
+def open_gtf(gtf_file):
+    """Open a plain or gzip-compressed GTF file for reading text"""
+    with open(gtf_file, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(gtf_file, 'rt')
+    return open(gtf_file, 'r')
+
+def iter_gtf_records(gtf_file, feature='gene'):
+    """
+    Stream the records of one feature type (column 3) from a GTF file.
+
+    Lines of other features are skipped before being split, so only the
+    matching records are ever held in memory.
+
+    Yields:
+        list: The 9 GTF fields of each matching record (as strings)
+    """
+    with open_gtf(gtf_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t', 3)
+            if len(fields) < 4 or fields[2] != feature:
+                continue
+            fields = fields[:3] + fields[3].split('\t')
+            if len(fields) < 9:
+                continue
+            yield fields[:9]
+
+def read_gtf_features(gtf_file, feature='gene'):
+    """
+    Read the records of one feature type from a (optionally gzipped) GTF file.
+
+    Returns:
+        pd.DataFrame with GTF_COLUMNS, start/end as int64
+    """
+    records = pd.DataFrame(list(iter_gtf_records(gtf_file, feature)), columns=GTF_COLUMNS)
+    records['start'] = records['start'].astype(np.int64)
+    records['end'] = records['end'].astype(np.int64)
+    return records
+
+def extract_gene_attributes(attributes, keys=GENE_ATTRIBUTES):
+    """
+    Vectorized extraction of gene attributes from a column of GTF attribute strings.
+
+    Args:
+        attributes: pd.Series (or sequence) of GTF attribute strings
+        keys: Attribute names to extract (default: gene_id, gene_name, gene_type)
+
+    Returns:
+        pd.DataFrame with one column per key (NaN where the attribute is missing)
+    """
+    attributes = pd.Series(attributes, dtype=object).reset_index(drop=True)
+    return pd.DataFrame({
+        key: attributes.str.extract(rf'(?:^|;)\s*{key} "([^"]*)"', expand=False)
+        for key in keys
+    })
+
+def parse_gtf_genes(gtf_file):
+    """
+    Parse the 'gene' records of a GTF file into a typed gene table.
+
+    Returns:
+        pd.DataFrame with GENE_TABLE_COLUMNS (GTF 1-based coordinates)
+    """
+    genes = read_gtf_features(gtf_file, feature='gene')
+
+    info = extract_gene_attributes(genes['attributes'])
+
+    table = pd.DataFrame({
+        'gene_id': info['gene_id'].values,
+        'gene_name': info['gene_name'].values,
+        'gene_type': info['gene_type'].values,
+        'chr': genes['chr'].values,
+        'start': genes['start'].values,
+        'end': genes['end'].values,
+        'strand': genes['strand'].values
+    })
+    return table
+
+
+######################## Annotation cache ########################################################################################################################################################################
+def file_content_hash(path, block_size=1 << 24):
+    """Hash the content of a file (blake2b, 16 hex chars)"""
+    digest = hashlib.blake2b(digest_size=8)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def stamped_content_hash(path):
+    """
+    Content hash of a file, remembered in a `{path}.hash.json` stamp.
+
+    The stamp stores the file size and mtime next to the hash; the file is only
+    re-hashed when either changes.
+    """
+    st = os.stat(path)
+    stamp_file = f"{path}.hash.json"
+
+    try:
+        with open(stamp_file) as f:
+            stamp = json.load(f)
+        if stamp['size'] == st.st_size and stamp['mtime_ns'] == st.st_mtime_ns:
+            return stamp['hash']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    content_hash = file_content_hash(path)
+    try:
+        with open(stamp_file, 'w') as f:
+            json.dump({'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': content_hash}, f)
+    except OSError as e:
+        print(f"Warning: could not write hash stamp {stamp_file}: {str(e)}")
+    return content_hash
+
+def gtf_content_hash(gtf_file):
+    """
+    Content hash of a GTF file.
+
+    Hashing a full GENCODE GTF takes a few seconds, so the hash is remembered in a
+    stamp file next to the GTF (see stamped_content_hash).
+    """
+    return stamped_content_hash(gtf_file)
+
+def annotation_cache_path(gtf_file, cache_dir=None):
+    """Path of the cached gene table for a GTF file (keyed by content hash)"""
+    cache_dir = cache_dir or os.path.dirname(os.path.abspath(gtf_file))
+    base = os.path.basename(gtf_file)
+    return os.path.join(cache_dir, f"{base}.genes.v{ANNOTATION_CACHE_VERSION}.{gtf_content_hash(gtf_file)}.npz")
+
+def save_gene_table(table, cache_file):
+    """Write a gene table to a compressed NPZ file with typed columns"""
+    chr_codes, chr_names = pd.factorize(table['chr'], sort=True)
+    tmp_file = f"{cache_file}.tmp.npz"
+    np.savez_compressed(
+        tmp_file,
+        gene_id=table['gene_id'].fillna('').to_numpy(dtype=str),
+        gene_name=table['gene_name'].fillna('').to_numpy(dtype=str),
+        gene_type=table['gene_type'].fillna('').to_numpy(dtype=str),
+        chr_code=chr_codes.astype(np.int16),
+        chr_names=np.asarray(chr_names, dtype=str),
+        start=table['start'].to_numpy(dtype=np.int64),
+        end=table['end'].to_numpy(dtype=np.int64),
+        strand=table['strand'].to_numpy(dtype='U1')
+    )
+    os.replace(tmp_file, cache_file)
+
+def read_gene_table(cache_file):
+    """Read a gene table written by save_gene_table"""
+    with np.load(cache_file, allow_pickle=False) as data:
+        table = pd.DataFrame({
+            'gene_id': data['gene_id'].astype(object),
+            'gene_name': data['gene_name'].astype(object),
+            'gene_type': data['gene_type'].astype(object),
+            'chr': data['chr_names'].astype(object)[data['chr_code']],
+            'start': data['start'],
+            'end': data['end'],
+            'strand': data['strand'].astype(object)
+        })
+
+    # Missing attributes are stored as empty strings
+    for col in ['gene_id', 'gene_name', 'gene_type']:
+        table.loc[table[col] == '', col] = np.nan
+    return table
+
+def load_gene_table(gtf_file, cache_dir=None, use_cache=True):
+    """
+    Load the gene table of a GTF file, using the on-disk cache when available.
+
+    Args:
+        gtf_file: Path to GTF file, plain or gzipped (e.g. gencode.vM10.annotation.gtf)
+        cache_dir: Directory for the cache file (default: next to the GTF)
+        use_cache: Set to False to always re-parse the GTF
+
+    Returns:
+        pd.DataFrame with columns gene_id, gene_name, gene_type, chr, start, end, strand
+    """
+    if not os.path.exists(gtf_file):
+        raise FileNotFoundError(f"GTF file not found: {gtf_file}")
+
+    if not use_cache:
+        return parse_gtf_genes(gtf_file)
+
+    cache_file = annotation_cache_path(gtf_file, cache_dir)
+    if os.path.exists(cache_file):
+        try:
+            return read_gene_table(cache_file)
+        except Exception as e:
+            print(f"Warning: could not read annotation cache {cache_file}: {str(e)}")
+
+    print(f"Parsing {gtf_file} (annotation cache miss)...")
+    table = parse_gtf_genes(gtf_file)
+
+    try:
+        # Drop caches of previous versions of the same GTF
+        prefix = cache_file.rsplit('.genes.', 1)[0]
+        for old_file in glob.glob(f"{prefix}.genes.v*.npz"):
+            os.remove(old_file)
+        save_gene_table(table, cache_file)
+        print(f"Saved annotation cache: {cache_file}")
+    except OSError as e:
+        print(f"Warning: could not write annotation cache {cache_file}: {str(e)}")
+
+    return table
+
+
+######################## Gene identifiers ########################################################################################################################################################################
+@lru_cache(maxsize=None)
+def standardize_gene_name(gene_name):
+    """Standardize gene names to match between DEA and GTF"""
+    if pd.isna(gene_name):
+        return None
+    
+    # Convert to string if not already
+    gene_name = str(gene_name)
+    
+    # Remove version numbers if present (e.g., Gene.1 -> Gene)
+    gene_name = gene_name.split('.')[0]
+    
+    # Remove common prefixes/suffixes that might differ between annotations
+    for prefix in GENE_NAME_PREFIXES:
+        if gene_name.startswith(prefix):
+            gene_name = gene_name[len(prefix):]
+    
+    return gene_name.strip()
+
+def standardize_gene_names(gene_names):
+    """
+    Batch standardize_gene_name() over a whole column.
+
+    Identifiers are factorized first, so each distinct value is standardized
+    once and the results are broadcast back with a single take.
+
+    Args:
+        gene_names: pd.Series (or array-like) of gene symbols / Ensembl ids
+
+    Returns:
+        pd.Series (object) of standardized names, None where the input is missing
+    """
+    gene_names = pd.Series(gene_names, dtype=object)
+    codes, uniques = pd.factorize(gene_names)
+
+    # Missing values get code -1, which picks the trailing None
+    standardize = standardize_gene_name.__wrapped__
+    standardized = np.array([standardize(name) for name in uniques] + [None], dtype=object)
+    return pd.Series(standardized[codes], index=gene_names.index, dtype=object)
+
+def resolve_gene_identifiers(gene_names, gene_index, verbose=True):
+    """
+    Resolve DEA identifiers (symbols or Ensembl ids) to GeneIndex rows in one join.
+
+    Returns:
+        pd.DataFrame with gene_std and gene_row (-1 if unmatched), aligned to gene_names
+    """
+    gene_names = pd.Series(gene_names, dtype=object)
+    gene_std = standardize_gene_names(gene_names)
+    gene_row = gene_index.lookup_many(gene_std)
+    resolved = pd.DataFrame({'gene_std': gene_std, 'gene_row': gene_row}, index=gene_names.index)
+
+    if verbose:
+        unmatched = gene_names[(gene_row < 0)]
+        print(f"Resolved {len(gene_names) - len(unmatched)}/{len(gene_names)} identifiers to annotated genes")
+        if len(unmatched):
+            print(f"Unmatched identifiers: {len(unmatched)} "
+                  f"(e.g. {', '.join(map(str, unmatched.head(5)))})")
+    return resolved
+
+def resolve_dea_genes(dea, gene_index, gene_column='gene'):
+    """
+    Add gene_std / gene_row columns to a DEA table (in place).
+
+    Tables that already carry them (e.g. from load_dea) are left untouched.
+    """
+    if 'gene_row' not in dea.columns:
+        resolved = resolve_gene_identifiers(dea[gene_column], gene_index)
+        dea['gene_std'] = resolved['gene_std']
+        dea['gene_row'] = resolved['gene_row']
+    return dea
+
+# Resolved DEA tables, keyed by file identity
+_dea_cache = {}
+
+def load_dea(dea_file, gene_index, gene_column='gene'):
+    """
+    Read a DEA table and resolve its identifiers against gene_index.
+
+    The resolved table is cached per DEA file (path, size, mtime) and gene
+    index, so every analysis of the same run shares one resolution. A copy is
+    returned so callers can add columns freely.
+    """
+    stat = os.stat(dea_file)
+    key = (os.path.realpath(dea_file), stat.st_size, stat.st_mtime_ns, gene_column)
+
+    cached = _dea_cache.get(key)
+    if cached is None or cached[0] is not gene_index:
+        dea = pd.read_csv(dea_file)
+        resolve_dea_genes(dea, gene_index, gene_column)
+        _dea_cache[key] = (gene_index, dea)
+    return _dea_cache[key][1].copy()
+
+
+
+######################## DEA index ########################################################################################################################################################################
+def expression_categories(log2fc, padj, log2fc_threshold=1, padj_threshold=0.05, unchanged='rest'):
+    """
+    Up/down/non-deregulated category of every DEA gene in one vectorized pass.
+
+    Args:
+        log2fc, padj: log2FoldChange and padj columns
+        log2fc_threshold: log2FoldChange a significant gene must exceed (in
+                          absolute value) to count as up/down-regulated
+        padj_threshold: padj below which a gene is significant
+        unchanged: 'rest' puts every other gene in non-deregulated;
+                   'not_significant' only genes with padj >= padj_threshold (or
+                   missing), leaving significant small changes uncategorized
+
+    Returns:
+        np.ndarray (object) of category names, None for uncategorized genes
+    """
+    log2fc = np.asarray(log2fc, dtype=np.float64)
+    padj = np.asarray(padj, dtype=np.float64)
+    significant = padj < padj_threshold
+    up = significant & (log2fc > log2fc_threshold)
+    down = significant & (log2fc < -log2fc_threshold)
+
+    if unchanged == 'rest':
+        default = 'non-deregulated'
+    elif unchanged == 'not_significant':
+        default = np.where(significant, None, 'non-deregulated').astype(object)
+    else:
+        raise ValueError(f"Unknown non-deregulated rule: {unchanged}")
+    return np.select([up, down], ['up-regulated', 'down-regulated'], default).astype(object)
+
+class DEAIndex:
+    """
+    DEA table keyed by gene identifier, with expression categories assigned once.
+
+    Each identifier maps to the first table row carrying it (as
+    dea[dea[key] == gene].iloc[0]); single lookups are hash lookups and batch
+    lookups a single get_indexer.
+    """
+    def __init__(self, dea, key_column='gene_std', log2fc_threshold=1, padj_threshold=0.05,
+                 unchanged='rest'):
+        """
+        Parameters:
+        -----------
+        dea : pd.DataFrame
+            DEA table with log2FoldChange, padj and the key column
+        key_column : str
+            Identifier column to index ('gene_std' from load_dea, or 'gene')
+        log2fc_threshold, padj_threshold, unchanged :
+            Category rule (see expression_categories)
+        """
+        self.table = dea
+        self.key_column = key_column
+        self.category = expression_categories(dea['log2FoldChange'], dea['padj'], log2fc_threshold,
+                                              padj_threshold, unchanged)
+
+        keys = dea[key_column]
+        first = (keys.notna() & ~keys.duplicated()).to_numpy()
+        self._keys = pd.Index(keys.to_numpy(dtype=object)[first], dtype=object)
+        self._positions = np.flatnonzero(first)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, gene):
+        return gene in self._keys
+
+    def lookup(self, gene):
+        """Table position of an identifier, or -1 if absent"""
+        return int(self._positions[self._keys.get_loc(gene)]) if gene in self._keys else -1
+
+    def lookup_many(self, genes):
+        """
+        Table positions of many identifiers at once.
+
+        Returns:
+            np.ndarray (int64) of positions, -1 for absent identifiers
+        """
+        positions = self._keys.get_indexer(pd.Index(genes, dtype=object))
+        return np.where(positions >= 0, self._positions[positions], -1)
+
+    def row(self, gene):
+        """DEA row of an identifier (KeyError if absent)"""
+        position = self.lookup(gene)
+        if position < 0:
+            raise KeyError(gene)
+        return self.table.iloc[position]
+
+    def take(self, genes, columns=('log2FoldChange', 'padj')):
+        """
+        DEA columns of many identifiers, aligned to genes.
+
+        Returns:
+            pd.DataFrame indexed by genes, NaN rows for absent identifiers
+        """
+        positions = self.lookup_many(genes)
+        values = self.table[list(columns)].iloc[np.maximum(positions, 0)]
+        values.index = pd.Index(genes, dtype=object)
+        return values.mask(np.broadcast_to((positions < 0)[:, None], values.shape))
+
+    def genes(self, category, column=None):
+        """Identifiers (key_column or column) of the rows in a category, in table order"""
+        column = column or self.key_column
+        selected = (self.category == category) & self.table[column].notna().to_numpy()
+        return self.table[column][selected].tolist()
+
+    def categorized(self):
+        """Copy of the DEA table with a category column"""
+        return self.table.assign(category=self.category)
+
+
+######################## Gene index ########################################################################################################################################################################
+class GeneIndex:
+    """
+    Compact gene lookup keyed by standardized gene name / gene id.
+
+    Each identifier maps to an integer row; coordinates are stored as typed
+    NumPy arrays (chr code, start, end, strand) rather than one pandas row per
+    identifier.
+    """
+    def __init__(self, gene_table, key_columns=('gene_name_std', 'gene_id_std')):
+        """
+        Parameters:
+        -----------
+        gene_table : pd.DataFrame
+            Gene table with chr, start, end, strand, gene_name and the key columns
+        key_columns : tuple
+            Columns holding the (already standardized) identifiers of each gene
+        """
+        chr_code, chr_names = pd.factorize(gene_table['chr'], sort=True)
+        self.chr_names = np.asarray(chr_names, dtype=object)
+        self.chr_code = chr_code.astype(np.int16)
+        self.start = gene_table['start'].to_numpy(dtype=np.int64)
+        self.end = gene_table['end'].to_numpy(dtype=np.int64)
+        self.strand = np.where(gene_table['strand'].to_numpy() == '+', 1, -1).astype(np.int8)
+        self.gene_name = gene_table['gene_name'].to_numpy(dtype=object)
+
+        # Identifiers are inserted gene by gene (name, then id); on collisions the
+        # later gene wins, as with the name_to_info dict this replaces
+        keys = np.column_stack([gene_table[col].to_numpy(dtype=object) for col in key_columns]).ravel()
+        rows = np.repeat(np.arange(len(gene_table), dtype=np.int64), len(key_columns))
+        valid = pd.notna(keys)
+        self._row_of = dict(zip(keys[valid], rows[valid]))
+
+        self._keys = pd.Index(list(self._row_of.keys()), dtype=object)
+        self._rows = np.fromiter(self._row_of.values(), dtype=np.int64, count=len(self._row_of))
+        self._promoters = None
+
+    def __len__(self):
+        return len(self._row_of)
+
+    def __contains__(self, gene):
+        return gene in self._row_of
+
+    @property
+    def n_genes(self):
+        return len(self.start)
+
+    def lookup(self, gene):
+        """Row of a standardized identifier, or -1 if unknown"""
+        return self._row_of.get(gene, -1)
+
+    def lookup_many(self, genes):
+        """
+        Rows of many standardized identifiers at once.
+
+        Returns:
+            np.ndarray (int64) of rows, -1 for unknown identifiers
+        """
+        positions = self._keys.get_indexer(pd.Index(genes, dtype=object))
+        return np.where(positions >= 0, self._rows[positions], -1)
+
+    def locus(self, gene):
+        """(chr, start, end, strand) of a standardized identifier as plain Python values"""
+        row = self._row_of[gene]
+        return (self.chr_names[self.chr_code[row]], int(self.start[row]), int(self.end[row]),
+                '+' if self.strand[row] > 0 else '-')
+
+    def chromosomes(self, rows):
+        """Chromosome names of an array of rows"""
+        return self.chr_names[self.chr_code[rows]]
+
+    @property
+    def promoters(self):
+        """PromoterIndex over the genes of this index (built on first use)"""
+        if self._promoters is None:
+            self._promoters = PromoterIndex(self)
+        return self._promoters
+
+
+######################## Promoter index ########################################################################################################################################################################
+class PromoterIndex:
+    """
+    Strand-aware promoter (TSS) and gene-body windows for every gene.
+
+    TSS positions are computed once; windows of any upstream/downstream size
+    are derived with vectorized arithmetic and cached by size, so switching
+    between window definitions never re-parses the annotation.
+    """
+    def __init__(self, genes):
+        """
+        Parameters:
+        -----------
+        genes : GeneIndex or pd.DataFrame
+            Genes with chr, start, end and strand (GTF coordinates)
+        """
+        if isinstance(genes, GeneIndex):
+            self.chr_names = genes.chr_names
+            self.chr_code = genes.chr_code
+            self.start = genes.start
+            self.end = genes.end
+            self.strand = genes.strand
+        else:
+            chr_code, chr_names = pd.factorize(genes['chr'], sort=True)
+            self.chr_names = np.asarray(chr_names, dtype=object)
+            self.chr_code = chr_code.astype(np.int16)
+            self.start = genes['start'].to_numpy(dtype=np.int64)
+            self.end = genes['end'].to_numpy(dtype=np.int64)
+            self.strand = np.where(genes['strand'].to_numpy() == '+', 1, -1).astype(np.int8)
+
+        # TSS is the gene start on the + strand and the gene end on the - strand
+        self.tss = np.where(self.strand > 0, self.start, self.end)
+
+        self._windows = {}
+        self._intervals = {}
+
+    def __len__(self):
+        return len(self.tss)
+
+    def window(self, upstream, downstream=None, anchor='tss'):
+        """
+        Window coordinates of every gene, in gene-row order.
+
+        Args:
+            upstream: bp upstream of the anchor (strand-aware)
+            downstream: bp downstream of the anchor (default: same as upstream)
+            anchor: 'tss' for TSS-centred promoters, 'gene' for the gene body
+
+        Returns:
+            tuple: (starts, ends) int64 arrays, starts clipped at 0
+        """
+        downstream = upstream if downstream is None else downstream
+        key = (anchor, upstream, downstream)
+        if key not in self._windows:
+            if anchor == 'tss':
+                left_ref, right_ref = self.tss, self.tss
+            elif anchor == 'gene':
+                left_ref, right_ref = self.start, self.end
+            else:
+                raise ValueError(f"Unknown window anchor: {anchor}")
+
+            plus = self.strand > 0
+            starts = np.where(plus, left_ref - upstream, left_ref - downstream)
+            ends = np.where(plus, right_ref + downstream, right_ref + upstream)
+            self._windows[key] = (np.maximum(starts, 0), ends)
+        return self._windows[key]
+
+    def region(self, row, upstream, downstream=None, anchor='tss'):
+        """(start, end) window of a single gene row as plain ints"""
+        starts, ends = self.window(upstream, downstream, anchor)
+        return int(starts[row]), int(ends[row])
+
+    def intervals(self, upstream, downstream=None, anchor='tss'):
+        """
+        Per-chromosome windows sorted by start.
+
+        Returns:
+            dict: chr -> (rows, starts, ends) arrays, sorted by start
+        """
+        downstream = upstream if downstream is None else downstream
+        key = (anchor, upstream, downstream)
+        if key not in self._intervals:
+            starts, ends = self.window(upstream, downstream, anchor)
+            order = np.lexsort((starts, self.chr_code))
+            bounds = np.searchsorted(self.chr_code[order], np.arange(len(self.chr_names) + 1))
+
+            by_chr = {}
+            for code, chrom in enumerate(self.chr_names):
+                rows = order[bounds[code]:bounds[code + 1]]
+                if len(rows):
+                    by_chr[chrom] = (rows, starts[rows], ends[rows])
+            self._intervals[key] = by_chr
+        return self._intervals[key]
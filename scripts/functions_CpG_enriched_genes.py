@@ -18,6 +18,8 @@ import glob
 from IPython.display import Image, display
 from venn import venn
 
+from functions_Annotation import PromoterIndex, load_gene_table
+
 def get_peaks_with_cpg(peak_file, cpg_file, extend=300, coverage_threshold=20, genome_size_file="DATA/genome.size"):
     """
     Identifies peaks that overlap with CpG islands above a coverage threshold.
@@ -192,14 +194,10 @@ def get_genes_with_cpg_enrichment(peak_file, cpg_file, gtf_file, output_dir, cel
         print(f"No CpG-overlapping peaks found for {cell_type} {condition}")
         return {'genes': pd.DataFrame(), 'total_peaks': 0}
     
-    # 2. Extract and extend TSS regions
+    # 2. Write extended TSS regions
     try:
-        tss_bed = os.path.join(output_dir, "temp_tss.bed")
-        extract_tss_regions(gtf_file, tss_bed)
-        
         extended_tss = os.path.join(output_dir, "temp_extended_tss.bed")
-        subprocess.run(f"bedtools slop -i {tss_bed} -g {genome_size_file} -b {extend_tss} > {extended_tss}",
-                      shell=True, check=True)
+        extract_tss_windows(gtf_file, extended_tss, extend_tss, genome_size_file)
         
         # 3. Write CpG-overlapping peaks to temporary file
         temp_peaks = os.path.join(output_dir, "temp_cpg_peaks.bed")
@@ -276,44 +274,49 @@ def get_genes_with_cpg_enrichment(peak_file, cpg_file, gtf_file, output_dir, cel
         return {'genes': pd.DataFrame(), 'total_peaks': 0}
     finally:
         # Cleanup temporary files
-        for f in [tss_bed, extended_tss, temp_peaks]:
+        for f in [extended_tss, temp_peaks]:
             if os.path.exists(f):
                 os.remove(f)
 
 def extract_tss_regions(gtf_file, output_bed):
     """Extracts TSS regions from GTF file."""
-    with open(gtf_file) as fin, open(output_bed, 'w') as fout:
-        for line in fin:
-            if line.startswith('#'):
-                continue
-            
-            fields = line.strip().split('\t')
-            if fields[2] != "gene":
-                continue
-            
-            # Parse gene information
-            info_dict = {}
-            for item in fields[8].rstrip(';').split('; '):
-                try:
-                    key, value = item.strip().split(' ', 1)
-                    info_dict[key] = value.strip('"')
-                except ValueError:
-                    continue
-            
-            gene_name = info_dict.get('gene_name', '')
-            gene_type = info_dict.get('gene_type', '')
-            
-            if not gene_name or gene_type != "protein_coding":
-                continue
-            
-            # Get TSS position
-            chrom = fields[0]
-            if fields[6] == '+':
-                tss_pos = int(fields[3])
-                fout.write(f"{chrom}\t{tss_pos-1}\t{tss_pos}\t{gene_name}\n")
-            else:
-                tss_pos = int(fields[4])
-                fout.write(f"{chrom}\t{tss_pos-1}\t{tss_pos}\t{gene_name}\n")
+    genes = load_gene_table(gtf_file)
+    genes = genes[genes['gene_name'].notna() & (genes['gene_type'] == "protein_coding")]
+    
+    # Get TSS position
+    tss_pos = np.where(genes['strand'] == '+', genes['start'], genes['end'])
+    tss = pd.DataFrame({
+        'chr': genes['chr'].values,
+        'start': tss_pos - 1,
+        'end': tss_pos,
+        'gene_name': genes['gene_name'].values
+    })
+    tss.to_csv(output_bed, sep='\t', header=False, index=False)
+
+def extract_tss_windows(gtf_file, output_bed, extend_tss, genome_size_file):
+    """
+    Writes TSS ± extend_tss regions of protein-coding genes to a BED file.
+
+    Equivalent to extract_tss_regions() followed by `bedtools slop -b extend_tss`,
+    but the windows come from a PromoterIndex in one vectorized step. Ends are
+    clipped to the chromosome sizes; genes on chromosomes missing from
+    genome_size_file are skipped.
+    """
+    genes = load_gene_table(gtf_file)
+    genes = genes[genes['gene_name'].notna() & (genes['gene_type'] == "protein_coding")]
+    chrom_sizes = pd.read_csv(genome_size_file, sep='\t', header=None, usecols=[0, 1],
+                              names=['chr', 'size'], dtype={'chr': str})
+    chrom_sizes = chrom_sizes.set_index('chr')['size']
+    genes = genes[genes['chr'].isin(chrom_sizes.index)]
+
+    starts, ends = PromoterIndex(genes).window(extend_tss)
+    windows = pd.DataFrame({
+        'chr': genes['chr'].values,
+        'start': np.maximum(starts - 1, 0),
+        'end': np.minimum(ends, chrom_sizes.reindex(genes['chr']).to_numpy()),
+        'gene_name': genes['gene_name'].values
+    })
+    windows.to_csv(output_bed, sep='\t', header=False, index=False)
 
 def create_comparison_summary(results, output_dir):
     """Creates a summary of gene overlaps between conditions."""
@@ -1841,7 +1844,7 @@ def compare_exo_endo_coverage_common(data):
 #         return {'genes': pd.DataFrame(), 'total_peaks': 0}
 #     finally:
 #         # Cleanup temporary files
-#         for f in [tss_bed, extended_tss, temp_peaks]:
+#         for f in [extended_tss, temp_peaks]:
 #             if os.path.exists(f):
 #                 os.remove(f)
 
@@ -0,0 +1,94 @@
+# Standard library imports
+import json
+import os
+
+# Third party imports
+import pysam
+
+# Bump when the meaning of the cached depth changes
+DEPTH_CACHE_VERSION = 1
+
+
+######################## Depth from BAM ########################################################################################################################################################################
+def index_mapped_reads(bam_file):
+    """
+    Mapped-read total from the BAM index (as `samtools idxstats`), without
+    reading any alignments.
+
+    Returns:
+        int, or None if the BAM has no usable index
+    """
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        if not bam.check_index():
+            return None
+        return sum(stat.mapped for stat in bam.get_index_statistics())
+
+def scan_mapped_reads(bam_file, threads=4):
+    """Count mapped reads by decompressing the whole BAM (multithreaded BGZF)"""
+    with pysam.AlignmentFile(bam_file, "rb", threads=threads) as bam:
+        return sum(1 for read in bam.fetch(until_eof=True) if not read.is_unmapped)
+
+
+######################## Depth cache ########################################################################################################################################################################
+def depth_cache_path(bam_file):
+    """Sidecar file holding the cached depth of a BAM"""
+    return f"{bam_file}.depth.json"
+
+def read_cached_depth(bam_file):
+    """Cached depth of a BAM, or None if missing or stale (path, size or mtime changed)"""
+    st = os.stat(bam_file)
+    try:
+        with open(depth_cache_path(bam_file)) as f:
+            entry = json.load(f)
+        if (entry['version'] == DEPTH_CACHE_VERSION and entry['path'] == os.path.abspath(bam_file)
+                and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns):
+            return entry['mapped']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def write_cached_depth(bam_file, mapped, method):
+    """Store the depth of a BAM in its sidecar file"""
+    st = os.stat(bam_file)
+    entry = {'version': DEPTH_CACHE_VERSION, 'path': os.path.abspath(bam_file),
+             'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+             'mapped': int(mapped), 'method': method}
+    cache_file = depth_cache_path(bam_file)
+    try:
+        with open(f"{cache_file}.tmp", 'w') as f:
+            json.dump(entry, f)
+        os.replace(f"{cache_file}.tmp", cache_file)
+    except OSError as e:
+        print(f"Warning: could not write depth cache {cache_file}: {str(e)}")
+
+def sequencing_depth(bam_file, threads=4, use_cache=True):
+    """
+    Total mapped reads of a BAM file.
+
+    Resolution order: sidecar cache, BAM index statistics, full scan (only if
+    the BAM is not indexed). Index and scan results are written back to the
+    sidecar, so later runs resolve the depth without opening the BAM.
+
+    Args:
+        bam_file: Path to BAM file
+        threads: Decompression threads for the fallback scan
+        use_cache: Set to False to ignore and rewrite the sidecar
+
+    Returns:
+        int: Number of mapped reads
+    """
+    if not os.path.exists(bam_file):
+        raise FileNotFoundError(f"BAM file not found: {bam_file}")
+
+    if use_cache:
+        mapped = read_cached_depth(bam_file)
+        if mapped is not None:
+            return mapped
+
+    mapped, method = index_mapped_reads(bam_file), 'index'
+    if mapped is None:
+        print(f"Warning: BAM index missing for {bam_file}, counting reads")
+        mapped, method = scan_mapped_reads(bam_file, threads), 'scan'
+
+    write_cached_depth(bam_file, mapped, method)
+    return mapped
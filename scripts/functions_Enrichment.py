@@ -0,0 +1,875 @@
+# Standard library imports
+import time
+from functools import partial
+
+# Third party imports
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from functions_Peaks import PeakSet, as_peak_set, build_peak_sets, promoter_sweep_peaks, region_signal
+
+# Column order of the wide score table (same names as define_enrichment_methods)
+ENRICHMENT_METHODS = ['signal_ratio', 'peak_count', 'combined_score', 'statistical',
+                      'width_weighted', 'coverage_score', 'area_integration']
+
+# Methods where a smaller score is more enriched (p-values)
+LOWER_IS_ENRICHED = {'statistical'}
+
+# Largest number of shuffles of the permutation null drawn in one vectorized batch
+PERMUTATION_CHUNK = 50
+
+# Upper bound on shuffled peak positions held in memory per vectorized batch
+PERMUTATION_BATCH_CELLS = 4_000_000
+
+# Largest number of genes per task of the parallel promoter scoring
+SCORING_CHUNK = 2000
+
+# Regions per streamed block of the region x gene x DEA join
+REGION_CHUNK = 50_000
+
+
+######################## q-value weights ########################################################################################################################################################################
+def neg_log10_qvalue_clipped(qvalue):
+    """-log10(q) clipped to [0, 50] (area_integration weight of the NSC scripts)"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip(-np.log10(qvalue), 0, 50)
+
+def neg_log10_qvalue_floored(qvalue):
+    """-log10(q) with q floored at 1e-10 (area_integration weight of the NEU scripts)"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return -np.log10(np.clip(qvalue, 1e-10, None))
+
+
+######################## Columnar scoring ########################################################################################################################################################################
+def _grouped_sum(codes, values, n_genes):
+    """Per-gene sum skipping NaN (as pandas Series.sum)"""
+    values = np.asarray(values, dtype=np.float64)
+    return np.bincount(codes, weights=np.where(np.isnan(values), 0.0, values), minlength=n_genes)
+
+def gene_sums(codes, interval_ids, signal, width, weight, n_genes):
+    """
+    Grouped per-gene reductions over gene-peak pairs given as arrays.
+
+    Args:
+        codes: Gene code (0 .. n_genes - 1) of each pair
+        interval_ids: Peak interval of each pair (same id for identical coordinates)
+        signal, width, weight: signalValue, peak width and q-value weight of each pair
+        n_genes: Number of gene codes
+
+    Returns:
+        dict of arrays (length n_genes): n_rows, n_peaks (unique intervals),
+        signal_sum, signal_count, width_sum, width_signal_sum and area_sum
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    n_ids = int(interval_ids.max()) + 1 if len(interval_ids) else 1
+    pairs = np.sort(codes * n_ids + interval_ids)
+    unique_pairs = pairs[np.concatenate([[True], pairs[1:] != pairs[:-1]])] if len(pairs) else pairs
+    return {
+        'n_rows': np.bincount(codes, minlength=n_genes),
+        'n_peaks': np.bincount(unique_pairs // n_ids, minlength=n_genes),
+        'signal_sum': _grouped_sum(codes, signal, n_genes),
+        'signal_count': np.bincount(codes[~np.isnan(signal)], minlength=n_genes),
+        'width_sum': _grouped_sum(codes, width, n_genes),
+        'width_signal_sum': _grouped_sum(codes, width * signal, n_genes),
+        'area_sum': _grouped_sum(codes, width * signal * weight, n_genes)
+    }
+
+def summarize_gene_peaks(peaks, genes, qvalue_weight=neg_log10_qvalue_clipped):
+    """
+    Grouped per-gene reductions of a long gene-peak table.
+
+    Args:
+        peaks: Long table with gene, chr, start, end, signalValue and qValue
+               columns (functions_Peaks.promoter_peaks)
+        genes: Index of the genes to summarize
+        qvalue_weight: Peak weight derived from qValue for the area sums
+
+    Returns:
+        pd.DataFrame indexed by gene with the gene_sums columns
+    """
+    if not peaks.empty:
+        codes = genes.get_indexer(peaks['gene'])
+        peaks, codes = peaks[codes >= 0], codes[codes >= 0]
+    if peaks.empty:
+        empty = np.zeros(0)
+        return pd.DataFrame(gene_sums(empty, empty.astype(np.int64), empty, empty, empty, len(genes)),
+                            index=genes)
+
+    interval_ids = peaks.groupby(['chr', 'start', 'end'], sort=False).ngroup().to_numpy()
+    signal = peaks['signalValue'].to_numpy(dtype=np.float64)
+    width = (peaks['end'] - peaks['start']).to_numpy(dtype=np.float64)
+    weight = qvalue_weight(peaks['qValue'].to_numpy(dtype=np.float64))
+    return pd.DataFrame(gene_sums(codes, interval_ids, signal, width, weight, len(genes)), index=genes)
+
+def _expand_ranges(lengths):
+    """Owner index and offset within its range for ranges of the given lengths"""
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    offset = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return owner, offset
+
+def fisher_pvalues(exo_counts, endo_counts, total_genome_peaks):
+    """
+    Two-sided Fisher exact p-values of [[exo, endo], [total - exo, total - endo]]
+    for all genes at once; NaN where a table is invalid (negative cells).
+
+    Both columns of these tables sum to the genome total, so the hypergeometric
+    null of the exo count (exo + endo draws from 2 * total) is symmetric and the
+    two-sided p-value of scipy.stats.fisher_exact is min(1, 2 * P(X <= min(exo, endo))).
+    The lower tails of all tables are built together from log probability
+    ratios, instead of one fisher_exact call per gene.
+    """
+    exo_counts = np.asarray(exo_counts, dtype=np.int64)
+    endo_counts = np.asarray(endo_counts, dtype=np.int64)
+    total = int(total_genome_peaks)
+    pvalues = np.full(len(exo_counts), np.nan)
+
+    tested = np.flatnonzero((np.minimum(exo_counts, endo_counts) >= 0) &
+                            (np.maximum(exo_counts, endo_counts) <= total))
+    if not len(tested):
+        return pvalues
+    drawn = exo_counts[tested] + endo_counts[tested]
+    smaller = np.minimum(exo_counts, endo_counts)[tested]
+    low = np.maximum(0, drawn - total)
+
+    # log P(X = low): product over the draws when low is 0, scipy otherwise (total < drawn)
+    log_low = np.empty(len(tested))
+    from_zero = low == 0
+    owner, offset = _expand_ranges(drawn[from_zero])
+    log_low[from_zero] = np.bincount(owner, weights=np.log1p(-total / (2 * total - offset)),
+                                     minlength=from_zero.sum())
+    log_low[~from_zero] = stats.hypergeom.logpmf(low[~from_zero], 2 * total, drawn[~from_zero], total)
+
+    # log P(X = x) / P(X = x - 1) for x in (low, smaller]
+    lengths = smaller - low + 1
+    owner, offset = _expand_ranges(lengths)
+    x = (low[owner] + offset).astype(np.float64)
+    steps = np.zeros(len(x))
+    inner = offset > 0
+    k, xi = drawn[owner][inner], x[inner]
+    steps[inner] = (np.log((k - xi + 1) * (total - xi + 1)) -
+                    np.log(xi * (total - k + xi)))
+
+    # Running sums per table: each table's start cancels the previous table's
+    # sum, so the flat cumulative sum never grows large
+    starts = np.cumsum(lengths) - lengths
+    steps[starts[1:]] -= np.bincount(owner, weights=steps, minlength=len(tested))[:-1]
+    running = np.cumsum(steps)
+    log_pmf = log_low[owner] + running - running[starts][owner]
+
+    lower_tail = np.bincount(owner, weights=np.exp(log_pmf), minlength=len(tested))
+    pvalues[tested] = np.minimum(2 * lower_tail, 1.0)
+    return pvalues
+
+def bh_qvalues(pvalues):
+    """Benjamini-Hochberg adjusted p-values, ignoring (and keeping) NaN entries"""
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    qvalues = np.full(len(pvalues), np.nan)
+    tested = ~np.isnan(pvalues)
+    if tested.any():
+        qvalues[tested] = stats.false_discovery_control(pvalues[tested], method='bh')
+    return qvalues
+
+def method_scores(exo, endo, total_genome_peaks):
+    """
+    The define_enrichment_methods metrics from per-gene exo/endo reductions.
+
+    Args:
+        exo, endo: gene_sums of each condition (dicts of arrays or DataFrames)
+        total_genome_peaks: Genome-wide peak total of the Fisher test
+
+    Returns:
+        dict: method name -> array of scores, in ENRICHMENT_METHODS order
+    """
+    exo = {col: np.asarray(exo[col], dtype=np.float64) for col in exo}
+    endo = {col: np.asarray(endo[col], dtype=np.float64) for col in endo}
+    has_exo = exo['n_rows'] > 0
+    both = has_exo & (endo['n_rows'] > 0)
+
+    def ratio(exo_values, endo_values):
+        """exo / max(endo, 1) where both sides have peaks, 0 without exo peaks"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = exo_values / np.maximum(endo_values, 1)
+        return np.where(both, values, np.where(has_exo, np.nan, 0.0))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exo_mean = exo['signal_sum'] / np.where(exo['signal_count'] > 0, exo['signal_count'], np.nan)
+        endo_mean = endo['signal_sum'] / np.where(endo['signal_count'] > 0, endo['signal_count'], np.nan)
+        mean_ratio = exo_mean / endo_mean
+        peak_ratio = exo['n_peaks'] / np.maximum(endo['n_peaks'], 1)
+
+    statistical = np.full(len(both), np.nan)
+    statistical[both] = fisher_pvalues(exo['n_peaks'][both], endo['n_peaks'][both], total_genome_peaks)
+
+    return {
+        'signal_ratio': np.where(both, mean_ratio, np.where(has_exo, np.inf, 0.0)),
+        'peak_count': np.where(both, peak_ratio, np.nan),
+        'combined_score': ratio(exo_mean * exo['n_peaks'], endo_mean * endo['n_peaks']),
+        'statistical': statistical,
+        'width_weighted': ratio(exo['width_signal_sum'], endo['width_signal_sum']),
+        'coverage_score': ratio(exo['width_sum'] * exo_mean, endo['width_sum'] * endo_mean),
+        'area_integration': ratio(exo['area_sum'], endo['area_sum'])
+    }
+
+def score_enrichment(exo_peaks, endo_peaks, total_genome_peaks, qvalue_weight=neg_log10_qvalue_clipped):
+    """
+    Every enrichment method for every gene at once, from long gene-peak tables.
+
+    Columnar equivalent of applying the define_enrichment_methods lambdas to
+    each gene's exo/endo peak frames: each metric is built from grouped sums,
+    means and unique-peak counts instead of per-gene groupby calls. A gene with
+    no peaks on one side gets NaN wherever the lambda would need that side's
+    columns (the per-gene path raises on the empty frame and skips the gene).
+
+    Args:
+        exo_peaks, endo_peaks: Long gene-peak tables (functions_Peaks.promoter_peaks)
+        total_genome_peaks: Genome-wide peak total of the Fisher test
+        qvalue_weight: area_integration weight (neg_log10_qvalue_clipped or
+                       neg_log10_qvalue_floored, matching the script's lambda)
+
+    Returns:
+        pd.DataFrame indexed by gene, one column per method (ENRICHMENT_METHODS)
+        plus statistical_qvalue, the BH-adjusted statistical p-values
+    """
+    gene_parts = [peaks['gene'] for peaks in (exo_peaks, endo_peaks) if not peaks.empty]
+    genes = pd.Index(np.unique(np.concatenate(gene_parts)) if gene_parts else [], name='gene')
+
+    exo = summarize_gene_peaks(exo_peaks, genes, qvalue_weight)
+    endo = summarize_gene_peaks(endo_peaks, genes, qvalue_weight)
+    return _score_table(exo, endo, total_genome_peaks)
+
+def _score_table(exo, endo, total_genome_peaks):
+    """Wide score table from per-gene reductions indexed by gene"""
+    scores = pd.DataFrame(method_scores(exo, endo, total_genome_peaks), index=exo.index)
+    scores['statistical_qvalue'] = bh_qvalues(scores['statistical'])
+    return scores
+
+
+######################## Parallel scoring ########################################################################################################################################################################
+def _pooled_peaks(peak_sets, prepare=None):
+    """Peaks of all samples of one condition with a sample column, in sample order, then peak row"""
+    frames = [as_peak_set(peaks).peaks.assign(sample=sample) for sample, peaks in peak_sets.items()]
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=['chr', 'start', 'end', 'signalValue', 'qValue', 'sample'])
+    peaks = pd.concat(frames, ignore_index=True)
+    return prepare(peaks) if prepare is not None else peaks
+
+def _scoring_columns(condition, peaks, chr_names, qvalue_weight):
+    """Chromosome-sorted coordinate and score columns of a pooled peak table, named {condition}_*"""
+    from functions_Parallel import chromosome_bounds
+
+    codes = chr_names.get_indexer(peaks['chr'].to_numpy(dtype=object))
+    starts = peaks['start'].to_numpy(dtype=np.int64)
+    ends = peaks['end'].to_numpy(dtype=np.int64)
+    # Peaks on chromosomes without promoters cannot overlap one
+    rows = np.flatnonzero(codes >= 0)
+    order = rows[np.lexsort((starts[rows], codes[rows]))]
+    interval_ids = (peaks.groupby(['chr', 'start', 'end'], sort=False).ngroup().to_numpy(dtype=np.int64)
+                    if not peaks.empty else np.zeros(0, dtype=np.int64))
+    return {
+        f'{condition}_row': order,
+        f'{condition}_start': starts[order],
+        f'{condition}_end': ends[order],
+        f'{condition}_interval': interval_ids[order],
+        f'{condition}_signal': peaks['signalValue'].to_numpy(dtype=np.float64)[order],
+        f'{condition}_width': (ends - starts).astype(np.float64)[order],
+        f'{condition}_weight': qvalue_weight(peaks['qValue'].to_numpy(dtype=np.float64))[order],
+        f'{condition}_bounds': chromosome_bounds(codes[order], len(chr_names))
+    }
+
+def _score_chunk(columns, chunk):
+    """Promoter x peak pairs and per-gene reductions of one chromosome range of the shared promoters"""
+    code, lo, hi = chunk
+    genes = columns['gene_row'][lo:hi]
+    result = []
+    for condition in ('exo', 'endo'):
+        peak_lo, peak_hi = columns[f'{condition}_bounds'][code], columns[f'{condition}_bounds'][code + 1]
+        peaks = PeakSet(pd.DataFrame({'chr': 0, 'start': columns[f'{condition}_start'][peak_lo:peak_hi],
+                                      'end': columns[f'{condition}_end'][peak_lo:peak_hi]}))
+        query_idx, positions = peaks.query_chromosome(0, columns['gene_start'][lo:hi],
+                                                      columns['gene_end'][lo:hi])
+        positions = positions + peak_lo
+        sums = gene_sums(query_idx, columns[f'{condition}_interval'][positions],
+                         columns[f'{condition}_signal'][positions], columns[f'{condition}_width'][positions],
+                         columns[f'{condition}_weight'][positions], hi - lo)
+        result.append((genes[query_idx], columns[f'{condition}_row'][positions], sums))
+    return result
+
+def score_promoters(gene_index, rows, peak_sets_exo, peak_sets_endo, window, total_genome_peaks,
+                    qvalue_weight=neg_log10_qvalue_clipped, prepare=None, max_workers=1,
+                    chunk_size=SCORING_CHUNK):
+    """
+    Promoter x peak joins and enrichment scores of many genes, optionally in parallel.
+
+    The peaks of each condition are pooled over samples and, with the
+    promoters, sorted by chromosome; their coordinate and score columns go
+    to shared memory once (functions_Parallel.SharedColumns). Each task joins
+    one chromosome range of at most chunk_size promoters with that
+    chromosome's peaks and reduces the pairs per gene, so workers only receive
+    row ranges. The Fisher test and the BH correction run on the assembled
+    reductions of all genes, so the result is identical to the serial path
+    (promoter_peaks + score_enrichment) for any number of workers.
+
+    Args:
+        gene_index: GeneIndex of the annotation
+        rows: Gene rows to score (GeneIndex.lookup_many)
+        peak_sets_exo, peak_sets_endo: {sample: PeakSet or peaks DataFrame}
+        window: Promoter half-width around the TSS
+        total_genome_peaks: Genome-wide peak total of the Fisher test
+        qvalue_weight: As for score_enrichment
+        prepare: Optional row-wise function applied to each condition's pooled
+                 peaks (e.g. signal clean-up)
+        max_workers: Worker processes (1 runs serially in this process)
+        chunk_size: Largest number of genes per task
+
+    Returns:
+        tuple: (scores, exo_promoter_peaks, endo_promoter_peaks)
+    """
+    from functions_Parallel import SharedColumns, chromosome_bounds, chromosome_chunks, map_shared
+
+    start_time = time.perf_counter()
+    rows = np.asarray(rows, dtype=np.int64)
+    rows = np.unique(rows[rows >= 0])
+    chroms = gene_index.chromosomes(rows)
+    chr_names = pd.Index(pd.unique(chroms))
+    gene_codes = chr_names.get_indexer(chroms)
+    gene_order = np.argsort(gene_codes, kind='stable')
+    gene_rows = rows[gene_order]
+    promoter_starts, promoter_ends = gene_index.promoters.window(window)
+
+    columns = {'gene_row': gene_rows, 'gene_start': promoter_starts[gene_rows],
+               'gene_end': promoter_ends[gene_rows]}
+    pooled = {}
+    for condition, peak_sets in (('exo', peak_sets_exo), ('endo', peak_sets_endo)):
+        pooled[condition] = _pooled_peaks(peak_sets, prepare)
+        columns.update(_scoring_columns(condition, pooled[condition], chr_names, qvalue_weight))
+    chunks = chromosome_chunks(chromosome_bounds(gene_codes[gene_order], len(chr_names)), chunk_size)
+
+    with SharedColumns(columns) as shared:
+        results = map_shared(_score_chunk, shared, chunks, max_workers, desc='Promoter scoring')
+    results = list(results.values())
+
+    # Long tables ordered by gene, then sample, then peak row (the pooled row
+    # order), as promoter_peaks; chunk reductions follow gene_rows
+    peaks, sums = [], []
+    for index, condition in enumerate(('exo', 'endo')):
+        genes = np.concatenate([np.zeros(0, dtype=np.int64)] + [result[index][0] for result in results])
+        peak_rows = np.concatenate([np.zeros(0, dtype=np.int64)] + [result[index][1] for result in results])
+        order = np.lexsort((peak_rows, genes))
+        table = pd.DataFrame()
+        if len(order):
+            table = pooled[condition].iloc[peak_rows[order]].reset_index(drop=True)
+            table['gene'] = genes[order]
+        peaks.append(table)
+        parts = [pd.DataFrame(result[index][2]) for result in results]
+        sums.append(pd.concat(parts, ignore_index=True) if parts
+                    else summarize_gene_peaks(pd.DataFrame(), pd.Index([])))
+
+    # Genes with peaks on either side, as score_enrichment
+    scored = ((sums[0]['n_rows'] > 0) | (sums[1]['n_rows'] > 0)).to_numpy()
+    genes = pd.Index(gene_rows[scored], dtype=np.int64, name='gene')
+    exo, endo = (condition_sums[scored].set_axis(genes).sort_index() for condition_sums in sums)
+    scores = _score_table(exo, endo, total_genome_peaks)
+    print(f"Scored {len(rows)} promoters in {len(chunks)} chromosome chunks "
+          f"({time.perf_counter() - start_time:.1f}s)")
+    return scores, peaks[0], peaks[1]
+
+
+######################## Region signal ########################################################################################################################################################################
+def region_enrichment(regions, peaks_exo, peaks_endo, max_workers=1):
+    """
+    Exo/endo signal and enrichment of every region (e.g. CpG island).
+
+    Signals are the signalValue sums of the peaks overlapping each region
+    under BED rules (bedtools intersect -wa -wb), one interval join per
+    condition; enrichment is exo_signal / max(endo_signal, 1).
+
+    Args:
+        regions: DataFrame with chr, start and end columns
+        peaks_exo, peaks_endo: {sample: peaks DataFrame or PeakSet}
+        max_workers: Worker processes of region_signal (1 runs serially)
+
+    Returns:
+        pd.DataFrame with chr, start, end, exo_signal, endo_signal and
+        enrichment, one row per region in input order
+    """
+    chroms = regions['chr'].astype(str).to_numpy(dtype=object)
+    signals = [region_signal(chroms, regions['start'], regions['end'], build_peak_sets(peaks), half_open=True,
+                             max_workers=max_workers)
+               for peaks in (peaks_exo, peaks_endo)]
+    return pd.DataFrame({
+        'chr': regions['chr'].to_numpy(),
+        'start': regions['start'].to_numpy(),
+        'end': regions['end'].to_numpy(),
+        'exo_signal': signals[0],
+        'endo_signal': signals[1],
+        'enrichment': signals[0] / np.maximum(signals[1], 1)
+    })
+
+def overlap_enrichment(exo_peaks, endo_peaks):
+    """
+    Exo/endo enrichment of every pair of overlapping exo and endo peaks.
+
+    The overlap step (BED rules, as bedtools intersect -wa -wb of exo and
+    endo) returns the row positions of both partners, so signals and q-values
+    are array gathers rather than coordinate lookups of every overlap.
+
+    Args:
+        exo_peaks, endo_peaks: Peak tables with chr, start, end, signalValue
+                               and qValue columns (e.g. combined replicates)
+
+    Returns:
+        pd.DataFrame with chr, start, end (of the exo peak), exo_signal,
+        endo_signal, enrichment, exo_qValue and endo_qValue, one row per
+        overlapping pair, ordered by exo row and then endo row
+    """
+    endo_set = PeakSet(endo_peaks.assign(chr=endo_peaks['chr'].astype(str)))
+    starts = exo_peaks['start'].to_numpy(dtype=np.int64)
+    ends = exo_peaks['end'].to_numpy(dtype=np.int64)
+    # e.start < x.end and e.end > x.start  <=>  e.start <= x.end - 1 and e.end >= x.start + 1
+    exo_rows, endo_rows = endo_set.query_many(exo_peaks['chr'].astype(str).to_numpy(dtype=object),
+                                              starts + 1, ends - 1)
+
+    exo_signal = exo_peaks['signalValue'].to_numpy(dtype=np.float64)[exo_rows]
+    endo_signal = endo_peaks['signalValue'].to_numpy(dtype=np.float64)[endo_rows]
+    return pd.DataFrame({
+        'chr': exo_peaks['chr'].to_numpy()[exo_rows],
+        'start': starts[exo_rows],
+        'end': ends[exo_rows],
+        'exo_signal': exo_signal,
+        'endo_signal': endo_signal,
+        'enrichment': exo_signal / np.maximum(endo_signal, 1),
+        'exo_qValue': exo_peaks['qValue'].to_numpy()[exo_rows],
+        'endo_qValue': endo_peaks['qValue'].to_numpy()[endo_rows]
+    })
+
+def region_expression_chunks(regions, genes, dea_index, columns=('enrichment',), chunk_size=REGION_CHUNK):
+    """
+    Join regions with the genes they overlap and with the DEA of those genes.
+
+    The interval join (BED rules, as bedtools intersect -wa -wb of regions
+    and genes) yields region and gene row positions directly, so region
+    columns are gathered by position and DEA columns by one keyed lookup per
+    block (DEAIndex.lookup_many). Overlaps of genes absent from the DEA are
+    dropped. Work is linear in the number of overlaps, and only one block of
+    regions is joined at a time so large results can be streamed to disk.
+
+    Args:
+        regions: DataFrame with chr, start, end and the columns to carry
+        genes: Gene table with chr, start, end and gene_name columns
+        dea_index: DEAIndex keyed by gene name
+        columns: Region columns to carry into the result
+        chunk_size: Regions per block
+
+    Yields:
+        pd.DataFrame per block with chr, start, end, gene, columns,
+        log2FoldChange and padj, ordered by region and then gene row
+    """
+    gene_set = PeakSet(genes[['chr', 'start', 'end']].assign(chr=genes['chr'].astype(str)))
+    gene_names = genes['gene_name'].to_numpy(dtype=object)
+    dea_values = {col: dea_index.table[col].to_numpy() for col in ['log2FoldChange', 'padj']}
+
+    region_chr = regions['chr'].to_numpy()
+    chroms = regions['chr'].astype(str).to_numpy(dtype=object)
+    starts = regions['start'].to_numpy(dtype=np.int64)
+    ends = regions['end'].to_numpy(dtype=np.int64)
+    region_values = {col: regions[col].to_numpy() for col in columns}
+    for lo in range(0, len(regions), chunk_size):
+        hi = min(lo + chunk_size, len(regions))
+        # g.start < e and g.end > s  <=>  g.start <= e - 1 and g.end >= s + 1
+        query_idx, gene_rows = gene_set.query_many(chroms[lo:hi], starts[lo:hi] + 1, ends[lo:hi] - 1)
+        dea_rows = dea_index.lookup_many(gene_names[gene_rows])
+        found = dea_rows >= 0
+        region_rows = query_idx[found] + lo
+        dea_rows = dea_rows[found]
+
+        block = pd.DataFrame({
+            'chr': region_chr[region_rows],
+            'start': starts[region_rows],
+            'end': ends[region_rows],
+            'gene': gene_names[gene_rows[found]]
+        })
+        for col, values in region_values.items():
+            block[col] = values[region_rows]
+        for col, values in dea_values.items():
+            block[col] = values[dea_rows]
+        yield block
+
+
+######################## Window sweep ########################################################################################################################################################################
+def score_promoter_windows(gene_index, rows, peak_sets_exo, peak_sets_endo, windows, total_genome_peaks,
+                           qvalue_weight=neg_log10_qvalue_clipped, prepare=None):
+    """
+    Enrichment scores of several promoter windows from a single join.
+
+    The promoters are joined with the peaks once, at the largest window, and
+    each peak's distance to the TSS is recorded. Every window's scores come from
+    the peaks within that distance, so each block is identical to
+    score_enrichment on promoter_peaks at that window (BH q-values included,
+    computed per window).
+
+    Args:
+        gene_index, rows, peak_sets_exo, peak_sets_endo: As for score_promoters
+        windows: Promoter half-widths around the TSS
+        total_genome_peaks, qvalue_weight, prepare: As for score_promoters
+
+    Returns:
+        pd.DataFrame indexed by (window, gene) with the score_enrichment columns
+    """
+    start_time = time.perf_counter()
+    windows = sorted(set(windows))
+    exo_peaks = promoter_sweep_peaks(gene_index, rows, peak_sets_exo, windows, prepare)
+    endo_peaks = promoter_sweep_peaks(gene_index, rows, peak_sets_endo, windows, prepare)
+
+    def within(peaks, window):
+        return peaks if peaks.empty else peaks[peaks['tss_distance'] <= window]
+
+    sweep = pd.concat({window: score_enrichment(within(exo_peaks, window), within(endo_peaks, window),
+                                                total_genome_peaks, qvalue_weight)
+                       for window in windows}, names=['window'])
+    print(f"Scored {len(windows)} promoter windows from one join at {windows[-1]}bp "
+          f"({time.perf_counter() - start_time:.1f}s)")
+    return sweep
+
+
+######################## Permutation null ########################################################################################################################################################################
+def read_chrom_sizes(genome_size_file):
+    """Chromosome sizes from a two-column genome size file (as used by bedtools)"""
+    sizes = pd.read_csv(genome_size_file, sep='\t', header=None, usecols=[0, 1],
+                        names=['chr', 'size'], dtype={'chr': str})
+    return sizes.set_index('chr')['size']
+
+def read_shuffle_regions(bed_file, with_class=False):
+    """
+    Regions of a BED file for the peak shuffler.
+
+    Args:
+        bed_file: BED file (chr, start, end[, class])
+        with_class: Read the 4th column as the bin class (e.g. GC or CpG bin)
+    """
+    columns = ['chr', 'start', 'end', 'bin_class'] if with_class else ['chr', 'start', 'end']
+    return pd.read_csv(bed_file, sep='\t', header=None, usecols=range(len(columns)),
+                       names=columns, dtype={'chr': str}, comment='#')
+
+def _subtract_regions(chrom_sizes, excluded):
+    """Complement of the excluded regions within each chromosome"""
+    parts = []
+    for chrom, size in chrom_sizes.items():
+        regions = excluded[excluded['chr'] == chrom].sort_values('start')
+        starts = regions['start'].to_numpy(dtype=np.int64)
+        ends = np.maximum.accumulate(regions['end'].to_numpy(dtype=np.int64)) if len(regions) else starts
+
+        # Merge overlapping exclusions, then keep the gaps between them
+        first = np.flatnonzero(np.concatenate([[True], starts[1:] > ends[:-1]])) if len(starts) else starts
+        last = np.append(first[1:] - 1, len(starts) - 1) if len(starts) else starts
+        free_starts = np.concatenate([[0], ends[last]])
+        free_ends = np.concatenate([starts[first], [size]])
+        keep = free_ends > free_starts
+        parts.append(pd.DataFrame({'chr': chrom, 'start': free_starts[keep], 'end': free_ends[keep]}))
+    return pd.concat(parts, ignore_index=True)
+
+class PeakShuffler:
+    """
+    Random placement of peak intervals within their own chromosome.
+
+    A peak can move anywhere on its chromosome, outside excluded regions (e.g.
+    assembly gaps or blacklists), or, when bins are given, into any bin of its
+    own class (e.g. GC or CpG content bins), keeping its width. Positions are
+    drawn uniformly over the allowed space for whole batches of shuffles at once.
+    """
+    def __init__(self, chroms, starts, ends, chrom_sizes, excluded=None, bins=None):
+        """
+        Parameters:
+        -----------
+        chroms, starts, ends : array-like
+            Intervals to shuffle
+        chrom_sizes : pd.Series
+            Chromosome sizes (chr -> size); unused when bins are given
+        excluded : pd.DataFrame, optional
+            chr/start/end regions peaks must not be placed in
+        bins : pd.DataFrame, optional
+            chr/start/end/bin_class regions; a peak stays in bins of the class
+            of the bin holding its midpoint (peaks outside all bins stay put)
+        """
+        chroms = np.asarray(chroms, dtype=object)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.widths = np.asarray(ends, dtype=np.int64) - self.starts
+
+        if bins is not None:
+            segments = bins[['chr', 'start', 'end', 'bin_class']].reset_index(drop=True)
+            classes = self._bin_classes(chroms, self.starts + self.widths // 2, segments)
+        else:
+            if excluded is not None and len(excluded):
+                segments = _subtract_regions(chrom_sizes, excluded)
+            else:
+                segments = pd.DataFrame({'chr': chrom_sizes.index, 'start': 0, 'end': chrom_sizes.to_numpy()})
+            segments['bin_class'] = 0
+            classes = np.zeros(len(chroms), dtype=np.int64)
+
+        # Pools of interchangeable segments: same chromosome and class
+        pool_codes, pools = pd.MultiIndex.from_arrays([segments['chr'], segments['bin_class']]).factorize()
+        self.pool = pools.get_indexer(pd.MultiIndex.from_arrays([chroms, classes]))
+
+        order = np.argsort(pool_codes, kind='stable')
+        self.seg_start = segments['start'].to_numpy(dtype=np.int64)[order]
+        self.seg_end = segments['end'].to_numpy(dtype=np.int64)[order]
+        lengths = (self.seg_end - self.seg_start).astype(np.float64)
+        self.cum_end = np.cumsum(lengths)
+        self.cum_start = self.cum_end - lengths
+        self.pool_length = np.bincount(pool_codes, weights=lengths, minlength=len(pools))
+        self.pool_base = self.cum_start[np.searchsorted(pool_codes[order], np.arange(len(pools)))]
+
+    @staticmethod
+    def _bin_classes(chroms, midpoints, bins):
+        """Class of the bin holding each midpoint, -1 outside all bins"""
+        classes = np.full(len(chroms), -1, dtype=object)
+        for chrom, chrom_bins in bins.groupby('chr'):
+            chrom_bins = chrom_bins.sort_values('start')
+            idx = np.flatnonzero(chroms == chrom)
+            pos = np.searchsorted(chrom_bins['start'].to_numpy(), midpoints[idx], 'right') - 1
+            inside = (pos >= 0) & (midpoints[idx] < chrom_bins['end'].to_numpy()[np.maximum(pos, 0)])
+            classes[idx[inside]] = chrom_bins['bin_class'].to_numpy()[pos[inside]]
+        return classes
+
+    def shuffle(self, rng, n):
+        """
+        New start positions for n shuffles.
+
+        Returns:
+            np.ndarray (n, n_intervals) of starts; intervals without an allowed
+            space keep their position
+        """
+        return _shuffle_starts(self.columns, rng, n)
+
+    @property
+    def columns(self):
+        """Arrays of the shuffler by name (shared with the permutation workers)"""
+        return {'pool': self.pool, 'starts': self.starts, 'widths': self.widths,
+                'seg_start': self.seg_start, 'seg_end': self.seg_end, 'cum_start': self.cum_start,
+                'cum_end': self.cum_end, 'pool_length': self.pool_length, 'pool_base': self.pool_base}
+
+def _shuffle_starts(columns, rng, n, lo=0, hi=None, prefix=''):
+    """PeakShuffler.shuffle of intervals lo..hi, from the shuffler columns named {prefix}*"""
+    pool = columns[prefix + 'pool'][lo:hi]
+    pool_length = columns[prefix + 'pool_length']
+    cum_start, cum_end = columns[prefix + 'cum_start'], columns[prefix + 'cum_end']
+    seg_start, seg_end = columns[prefix + 'seg_start'], columns[prefix + 'seg_end']
+
+    movable = pool >= 0
+    movable[movable] = pool_length[pool[movable]] > 0
+    pool = np.where(movable, pool, 0)
+
+    position = columns[prefix + 'pool_base'][pool] + rng.random((n, len(pool))) * pool_length[pool]
+    segment = np.minimum(np.searchsorted(cum_end, position, 'right'), len(cum_end) - 1)
+    starts = seg_start[segment] + (position - cum_start[segment]).astype(np.int64)
+    widths = columns[prefix + 'widths'][lo:hi]
+    starts = np.maximum(np.minimum(starts, seg_end[segment] - widths), seg_start[segment])
+    return np.where(movable, starts, columns[prefix + 'starts'][lo:hi])
+
+def _null_condition(peaks_dict, qvalue_weight, chr_names, prepare=None):
+    """
+    Arrays of one condition's peaks for the null.
+
+    Unique intervals on the chromosomes of chr_names, sorted by chromosome and
+    start (bounds per chromosome code), and the sample rows grouped by interval.
+    """
+    from functions_Parallel import chromosome_bounds
+
+    frames = [peaks for peaks in peaks_dict.values() if not peaks.empty]
+    peaks = pd.concat(frames or [pd.DataFrame(columns=['chr', 'start', 'end', 'signalValue', 'qValue'])],
+                      ignore_index=True)
+    if prepare is not None:
+        peaks = prepare(peaks)
+    # Peaks on chromosomes without promoters cannot overlap one
+    peaks = peaks[chr_names.get_indexer(peaks['chr'].to_numpy(dtype=object)) >= 0]
+
+    intervals = peaks[['chr', 'start', 'end']].drop_duplicates()
+    codes = chr_names.get_indexer(intervals['chr'].to_numpy(dtype=object))
+    order = np.lexsort((intervals['start'].to_numpy(dtype=np.int64), codes))
+    intervals = intervals.iloc[order].reset_index(drop=True)
+    interval_ids = pd.MultiIndex.from_frame(intervals).get_indexer(
+        pd.MultiIndex.from_frame(peaks[['chr', 'start', 'end']]))
+
+    rows = np.argsort(interval_ids, kind='stable')
+    return {
+        'intervals': intervals,
+        'bounds': chromosome_bounds(codes[order], len(chr_names)),
+        'offsets': np.concatenate([[0], np.cumsum(np.bincount(interval_ids, minlength=len(intervals)))]),
+        'row_interval': interval_ids[rows],
+        'row_signal': peaks['signalValue'].to_numpy(dtype=np.float64)[rows],
+        'row_width': (peaks['end'] - peaks['start']).to_numpy(dtype=np.float64)[rows],
+        'row_weight': qvalue_weight(peaks['qValue'].to_numpy(dtype=np.float64))[rows]
+    }
+
+def _null_sums(columns, condition, code, rng, n, promoters, n_genes):
+    """gene_sums of n shuffles of one chromosome's intervals (n shuffles x n_genes codes, flattened)"""
+    lo, hi = columns[f'{condition}_bounds'][code], columns[f'{condition}_bounds'][code + 1]
+    widths = columns[f'{condition}_widths'][lo:hi]
+    starts = _shuffle_starts(columns, rng, n, lo, hi, prefix=f'{condition}_').ravel()
+
+    # Interval x promoter overlaps of every shuffle
+    query_idx, genes = promoters.query_chromosome(0, starts, starts + np.tile(widths, n))
+    shuffle_idx = query_idx // max(hi - lo, 1)
+    interval_idx = lo + query_idx % max(hi - lo, 1)
+
+    # Each interval stands for all sample rows sharing its coordinates
+    offsets = columns[f'{condition}_offsets']
+    counts = offsets[interval_idx + 1] - offsets[interval_idx]
+    pair = np.repeat(np.arange(len(interval_idx)), counts)
+    rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + offsets[interval_idx][pair]
+
+    codes = shuffle_idx[pair] * n_genes + genes[pair]
+    interval_ids, signal, width, weight = (columns[f'{condition}_row_{name}'][rows]
+                                           for name in ('interval', 'signal', 'width', 'weight'))
+    return gene_sums(codes, interval_ids, signal, width, weight, n * n_genes)
+
+def _null_exceedances(columns, chunk, seed, n_permutations, total_genome_peaks):
+    """Null scores at least as extreme as observed for one chromosome range of the shared promoters"""
+    code, lo, hi = chunk
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=chunk))
+    observed = columns['observed'][lo:hi]
+    n_genes = hi - lo
+    promoters = PeakSet(pd.DataFrame({'chr': 0, 'start': columns['promoter_start'][lo:hi],
+                                      'end': columns['promoter_end'][lo:hi]}))
+    n_intervals = max(int(columns[f'{condition}_bounds'][code + 1] - columns[f'{condition}_bounds'][code])
+                      for condition in ('exo', 'endo'))
+    batch = max(1, min(PERMUTATION_CHUNK, PERMUTATION_BATCH_CELLS // max(n_intervals, 1)))
+    exceed = np.zeros(observed.shape, dtype=np.int64)
+
+    done = 0
+    while done < n_permutations:
+        n = min(batch, n_permutations - done)
+        sums = [_null_sums(columns, condition, code, rng, n, promoters, n_genes)
+                for condition in ('exo', 'endo')]
+        null = method_scores(sums[0], sums[1], total_genome_peaks)
+        for m, method_name in enumerate(ENRICHMENT_METHODS):
+            values = null[method_name].reshape(n, n_genes)
+            with np.errstate(invalid='ignore'):
+                if method_name in LOWER_IS_ENRICHED:
+                    exceed[:, m] += (values <= observed[:, m]).sum(axis=0)
+                else:
+                    exceed[:, m] += (values >= observed[:, m]).sum(axis=0)
+        done += n
+    return exceed
+
+def permutation_pvalues(scores, peaks_exo, peaks_endo, gene_index, window, total_genome_peaks,
+                        n_permutations=1000, seed=0, qvalue_weight=neg_log10_qvalue_clipped,
+                        chrom_sizes=None, excluded=None, bins=None, prepare=None, max_workers=None):
+    """
+    Empirical p-values of the enrichment scores under a peak shuffle null.
+
+    Each shuffle moves every exo and endo peak interval to a random position
+    on its chromosome (see PeakShuffler), re-joins the shuffled peaks with the
+    promoters and rescores all genes with the same columnar metrics as
+    score_enrichment. Peaks never leave their chromosome, so the null of a
+    chromosome's genes only involves that chromosome's peaks: the promoter,
+    peak and shuffler columns go to shared memory once
+    (functions_Parallel.SharedColumns) and each task runs all shuffles of one
+    chromosome, in vectorized batches, with its own seed derived from `seed`.
+    Results are reproducible and independent of max_workers.
+
+    Args:
+        scores: Observed score_enrichment table (index: gene rows)
+        peaks_exo, peaks_endo: {sample: peaks DataFrame}
+        gene_index: GeneIndex of the annotation
+        window: Promoter half-width around the TSS
+        total_genome_peaks: Genome-wide peak total of the Fisher test
+        n_permutations: Number of shuffles
+        seed: Seed of the whole null
+        qvalue_weight: area_integration weight (as for score_enrichment)
+        chrom_sizes: Genome size file or Series; default: extent of the peaks and promoters
+        excluded: BED file or chr/start/end table of regions to keep peaks out of
+        bins: BED file or chr/start/end/bin_class table of matched bins (GC/CpG)
+        prepare: Optional function applied to the concatenated peaks (as for promoter_peaks)
+        max_workers: Worker processes (1 runs in this process)
+
+    Returns:
+        pd.DataFrame indexed like scores, one column of (1 + #null as extreme) /
+        (1 + n_permutations) per method; NaN where the observed score is NaN
+    """
+    from functions_Parallel import SharedColumns, chromosome_bounds, chromosome_chunks, map_shared
+
+    start_time = time.perf_counter()
+    rows = scores.index.to_numpy(dtype=np.int64)
+    chroms = gene_index.chromosomes(rows)
+    chr_names = pd.Index(pd.unique(chroms))
+    codes = chr_names.get_indexer(chroms)
+    order = np.argsort(codes, kind='stable')
+    promoter_starts, promoter_ends = gene_index.promoters.window(window)
+    promoters = pd.DataFrame({'chr': chroms, 'start': promoter_starts[rows], 'end': promoter_ends[rows]})
+    exo = _null_condition(peaks_exo, qvalue_weight, chr_names, prepare)
+    endo = _null_condition(peaks_endo, qvalue_weight, chr_names, prepare)
+
+    if isinstance(chrom_sizes, str):
+        chrom_sizes = read_chrom_sizes(chrom_sizes)
+    elif chrom_sizes is None:
+        extent = pd.concat([exo['intervals'], endo['intervals'], promoters])
+        chrom_sizes = extent.groupby('chr')['end'].max()
+    if isinstance(excluded, str):
+        excluded = read_shuffle_regions(excluded)
+    if isinstance(bins, str):
+        bins = read_shuffle_regions(bins, with_class=True)
+
+    observed = scores[ENRICHMENT_METHODS].to_numpy(dtype=np.float64)
+    columns = {'promoter_start': promoters['start'].to_numpy()[order],
+               'promoter_end': promoters['end'].to_numpy()[order],
+               'observed': observed[order]}
+    for condition, arrays in (('exo', exo), ('endo', endo)):
+        intervals = arrays.pop('intervals')
+        shuffler = PeakShuffler(intervals['chr'], intervals['start'], intervals['end'],
+                                chrom_sizes, excluded, bins)
+        arrays.update(shuffler.columns)
+        columns.update({f'{condition}_{name}': values for name, values in arrays.items()})
+    chunks = chromosome_chunks(chromosome_bounds(codes[order], len(chr_names)))
+
+    task = partial(_null_exceedances, seed=seed, n_permutations=n_permutations,
+                   total_genome_peaks=total_genome_peaks)
+    with SharedColumns(columns) as shared:
+        results = map_shared(task, shared, chunks, max_workers, desc='Permutation null')
+    exceed = np.zeros(observed.shape, dtype=np.int64)
+    for (_, lo, hi), chunk_exceed in results.items():
+        exceed[order[lo:hi]] = chunk_exceed
+
+    pvalues = (1 + exceed) / (1 + n_permutations)
+    pvalues = pd.DataFrame(np.where(np.isnan(observed), np.nan, pvalues),
+                           index=scores.index, columns=ENRICHMENT_METHODS)
+    print(f"Permutation null: {n_permutations} shuffles x {len(scores)} genes in "
+          f"{time.perf_counter() - start_time:.1f}s")
+    return pvalues
+
+
+######################## Regression check ########################################################################################################################################################################
+def verify_enrichment_scores(scores, exo_by_gene, endo_by_gene, methods, rtol=1e-8):
+    """
+    Compare a score_enrichment table against the per-gene method lambdas.
+
+    Args:
+        scores: Wide table from score_enrichment
+        exo_by_gene, endo_by_gene: {gene: peaks DataFrame} (functions_Peaks.split_by_gene)
+        methods: {name: function(exo_peaks, endo_peaks)} (define_enrichment_methods)
+        rtol: Relative tolerance (grouped sums and the batched Fisher test round
+              differently from the per-gene lambdas)
+
+    Returns:
+        pd.DataFrame of mismatches (gene, method, expected, columnar), empty if all agree
+    """
+    start = time.perf_counter()
+    mismatches = []
+    for gene in scores.index:
+        exo = exo_by_gene.get(gene, pd.DataFrame())
+        endo = endo_by_gene.get(gene, pd.DataFrame())
+        for method_name, method_func in methods.items():
+            try:
+                expected = float(method_func(exo, endo))
+            except Exception:
+                expected = np.nan
+            columnar = scores.at[gene, method_name]
+            if not np.isclose(expected, columnar, rtol=rtol, atol=0, equal_nan=True):
+                mismatches.append({'gene': gene, 'method': method_name,
+                                   'expected': expected, 'columnar': columnar})
+
+    mismatches = pd.DataFrame(mismatches, columns=['gene', 'method', 'expected', 'columnar'])
+    print(f"Score check: {len(scores)} genes x {len(methods)} methods against the per-gene lambdas "
+          f"({time.perf_counter() - start:.1f}s), {len(mismatches)} mismatches")
+    return mismatches
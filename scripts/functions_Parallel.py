@@ -0,0 +1,179 @@
+# Standard library imports
+import multiprocessing as mp
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+# Third party imports
+import numpy as np
+from tqdm import tqdm
+
+
+######################## Shared columns ########################################################################################################################################################################
+class SharedColumns:
+    """
+    Named NumPy columns copied once into shared memory blocks.
+
+    Workers receive the small `descriptor` (block name, dtype and shape of each
+    column) instead of the arrays and map the same memory read-only, so the
+    columns are copied once in the parent whatever the number of tasks. Use
+    as a context manager: the blocks are released on exit.
+    """
+    def __init__(self, columns):
+        """
+        Parameters:
+        -----------
+        columns : dict
+            {name: array-like} of fixed-width (numeric) columns; object
+            columns (e.g. chromosome names) must be encoded first
+        """
+        self.columns = {}
+        self.descriptor = {}
+        self._blocks = []
+        try:
+            for name, values in columns.items():
+                self._share(name, np.ascontiguousarray(values))
+        except Exception:
+            self.close()
+            raise
+
+    def _share(self, name, values):
+        """Copy one column into a new block"""
+        if values.dtype == object:
+            raise TypeError(f"Column {name} has object dtype and cannot be shared")
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        self._blocks.append(block)
+        shared = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+        shared[...] = values
+        self.columns[name] = shared
+        self.descriptor[name] = (block.name, values.dtype.str, values.shape)
+
+    def close(self):
+        """Release (and unlink) the shared blocks"""
+        self.columns = {}
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def attach_columns(descriptor):
+    """
+    Map the columns of a SharedColumns descriptor in this process.
+
+    Returns:
+        tuple: ({name: read-only np.ndarray}, list of SharedMemory blocks to
+        keep alive while the arrays are in use)
+    """
+    columns, blocks = {}, []
+    for name, (block_name, dtype, shape) in descriptor.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        values = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        values.flags.writeable = False
+        columns[name] = values
+    return columns, blocks
+
+
+######################## Chromosome partitions ########################################################################################################################################################################
+def chromosome_bounds(codes, n_chromosomes):
+    """Row range [bounds[c], bounds[c + 1]) of every chromosome code of a code-sorted column"""
+    return np.searchsorted(codes, np.arange(n_chromosomes + 1))
+
+def chromosome_chunks(bounds, max_rows=None):
+    """
+    Split code-sorted rows into tasks that never cross a chromosome.
+
+    Args:
+        bounds: chromosome_bounds of the rows
+        max_rows: Largest task; larger chromosomes are split into several
+                  consecutive ranges (default: one task per chromosome)
+
+    Returns:
+        list of (code, lo, hi) row ranges, empty chromosomes skipped
+    """
+    chunks = []
+    for code in range(len(bounds) - 1):
+        lo, hi = int(bounds[code]), int(bounds[code + 1])
+        step = max_rows or max(hi - lo, 1)
+        chunks.extend((code, start, min(start + step, hi)) for start in range(lo, hi, step))
+    return chunks
+
+
+######################## Shared-memory executor ########################################################################################################################################################################
+_worker_columns = None
+_worker_blocks = None
+
+def _init_shared_worker(descriptor):
+    global _worker_columns, _worker_blocks
+    _worker_columns, _worker_blocks = attach_columns(descriptor)
+
+def _timed_task(task, chunk):
+    """Run task on the worker's shared columns, return (chunk, result, elapsed seconds)"""
+    start = time.perf_counter()
+    result = task(_worker_columns, chunk)
+    return chunk, result, time.perf_counter() - start
+
+def default_context():
+    """
+    fork where the platform has it, else the platform default start method.
+
+    Forked workers do not re-import the caller's __main__ module, so top-level
+    analysis scripts without a __main__ guard are safe; forkserver (the Linux
+    default from Python 3.14) and spawn (macOS, Windows) re-run it.
+    """
+    if 'fork' in mp.get_all_start_methods():
+        return mp.get_context('fork')
+    return mp.get_context()
+
+def map_shared(task, shared, chunks, max_workers=None, desc=None, mp_context=None):
+    """
+    Run task(columns, chunk) for every chunk over shared columns.
+
+    Each worker attaches the shared blocks once (pool initializer); a task only
+    pickles its chunk (e.g. a chromosome row range from chromosome_chunks) and
+    its result. Progress and the time of the last finished chunk are shown on
+    a tqdm bar.
+
+    Workers are forked by default (default_context). With a spawn or
+    forkserver mp_context they import the caller's __main__ module, which
+    must then keep its work under an `if __name__ == "__main__":` guard, and
+    task must be importable by module name.
+
+    Args:
+        task: Module-level function called as task(columns, chunk); columns
+              are read-only
+        shared: SharedColumns holding the task inputs
+        chunks: Hashable, picklable task descriptions
+        max_workers: Worker processes (1 runs serially on shared.columns)
+        desc: Progress bar label
+        mp_context: multiprocessing context of the pool (default: default_context())
+
+    Returns:
+        dict: chunk -> task result, in the order of chunks
+    """
+    chunks = list(chunks)
+    results = {}
+    with tqdm(total=len(chunks), desc=desc) as progress:
+        if max_workers == 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                start = time.perf_counter()
+                results[chunk] = task(shared.columns, chunk)
+                progress.set_postfix_str(f"{chunk}: {time.perf_counter() - start:.2f}s")
+                progress.update()
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context or default_context(),
+                                     initializer=_init_shared_worker,
+                                     initargs=(shared.descriptor,)) as executor:
+                futures = [executor.submit(_timed_task, task, chunk) for chunk in chunks]
+                for future in as_completed(futures):
+                    chunk, result, elapsed = future.result()
+                    results[chunk] = result
+                    progress.set_postfix_str(f"{chunk}: {elapsed:.2f}s")
+                    progress.update()
+    return {chunk: results[chunk] for chunk in chunks}
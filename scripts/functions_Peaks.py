@@ -0,0 +1,832 @@
+# Standard library imports
+import glob
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+# Third party imports
+import numpy as np
+import pandas as pd
+
+from functions_Annotation import stamped_content_hash
+
+NARROWPEAK_COLUMNS = ['chr', 'start', 'end', 'name', 'score',
+                      'strand', 'signalValue', 'pValue', 'qValue', 'peak']
+
+# SEACR *.peaks.stringent.bed: total signal, max signal, region of max signal
+SEACR_COLUMNS = ['chr', 'start', 'end', 'total_signal', 'max_signal', 'max_signal_region']
+
+# Bump when the on-disk layout of the peak cache changes
+PEAK_CACHE_VERSION = 1
+
+# Typed columns of the peak cache, one .npy file each
+PEAK_CACHE_DTYPES = {
+    'chr_code': np.int16,
+    'start': np.int32,
+    'end': np.int32,
+    'score': np.int32,
+    'signalValue': np.float32,
+    'pValue': np.float32,
+    'qValue': np.float32,
+    'peak': np.int32
+}
+
+# Regions per task of the shared-memory region_signal
+REGION_TASK_ROWS = 20_000
+
+
+######################## Peak file parsing ########################################################################################################################################################################
+def read_narrowpeak(peak_file):
+    """Read a MACS2 narrowPeak file as text"""
+    return pd.read_csv(peak_file, sep='\t', header=None, names=NARROWPEAK_COLUMNS,
+                       dtype={'chr': str, 'name': str, 'strand': str})
+
+def read_seacr_bed(peak_file):
+    """
+    Read a SEACR peak bed in the narrowPeak column layout.
+
+    The total signal becomes signalValue and the region of maximum signal is
+    kept as the peak name; its centre gives the summit offset. SEACR reports no
+    p/q-values, so these are NaN.
+    """
+    bed = pd.read_csv(peak_file, sep='\t', header=None, names=SEACR_COLUMNS,
+                      dtype={'chr': str, 'max_signal_region': str})
+
+    region = bed['max_signal_region'].str.extract(r':(\d+)-(\d+)$').astype(float)
+    summit = ((region[0] + region[1]) // 2 - bed['start']).fillna(-1)
+
+    return pd.DataFrame({
+        'chr': bed['chr'],
+        'start': bed['start'],
+        'end': bed['end'],
+        'name': bed['max_signal_region'],
+        'score': 0,
+        'strand': '.',
+        'signalValue': bed['total_signal'],
+        'pValue': np.nan,
+        'qValue': np.nan,
+        'peak': summit.astype(np.int64)
+    })
+
+PEAK_READERS = {
+    'narrowPeak': read_narrowpeak,
+    'seacr': read_seacr_bed
+}
+
+
+######################## Peak cache ########################################################################################################################################################################
+def peak_cache_path(peak_file, cache_dir=None):
+    """Directory of the binary cache for a peak file (keyed by content hash)"""
+    cache_dir = cache_dir or os.path.dirname(os.path.abspath(peak_file))
+    base = os.path.basename(peak_file)
+    return os.path.join(cache_dir, f"{base}.peaks.v{PEAK_CACHE_VERSION}.{stamped_content_hash(peak_file)}")
+
+def peak_table_to_arrays(peaks):
+    """
+    Typed column arrays of a peak table.
+
+    Chromosomes become int16 codes into the returned names; names and strands
+    are fixed-width bytes, so every column can be saved and memory-mapped.
+
+    Returns:
+        tuple: (dict of column -> np.ndarray, chromosome names as object array)
+    """
+    chr_codes, chr_names = pd.factorize(peaks['chr'], sort=True)
+    columns = {
+        'chr_code': chr_codes,
+        'start': peaks['start'],
+        'end': peaks['end'],
+        'score': pd.to_numeric(peaks['score'], errors='coerce').fillna(0),
+        'signalValue': peaks['signalValue'],
+        'pValue': peaks['pValue'],
+        'qValue': peaks['qValue'],
+        'peak': pd.to_numeric(peaks['peak'], errors='coerce').fillna(-1)
+    }
+    arrays = {col: np.asarray(values, dtype=PEAK_CACHE_DTYPES[col]) for col, values in columns.items()}
+    arrays['name'] = peaks['name'].fillna('').to_numpy(dtype=str).astype(np.bytes_)
+    arrays['strand'] = peaks['strand'].fillna('.').to_numpy(dtype=str).astype('S1')
+    return arrays, np.asarray(chr_names, dtype=object)
+
+def save_peak_cache(peaks, cache_path):
+    """Write a peak table as one typed .npy file per column plus meta.json"""
+    arrays, chr_names = peak_table_to_arrays(peaks)
+
+    tmp_path = f"{cache_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for col, values in arrays.items():
+        np.save(os.path.join(tmp_path, f"{col}.npy"), values)
+
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+        json.dump({'version': PEAK_CACHE_VERSION, 'n_peaks': len(peaks),
+                   'chr_names': [str(c) for c in chr_names]}, f)
+
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.replace(tmp_path, cache_path)
+
+def read_peak_arrays(cache_path, mmap_mode='r'):
+    """
+    Open a peak cache without copying.
+
+    Returns:
+        tuple: (dict of column -> memory-mapped array, chromosome names as object array)
+    """
+    with open(os.path.join(cache_path, "meta.json")) as f:
+        meta = json.load(f)
+
+    arrays = {}
+    for col in list(PEAK_CACHE_DTYPES) + ['name', 'strand']:
+        arrays[col] = np.load(os.path.join(cache_path, f"{col}.npy"), mmap_mode=mmap_mode)
+    if len(arrays['start']) != meta['n_peaks']:
+        raise ValueError(f"Incomplete peak cache: {cache_path}")
+    return arrays, np.asarray(meta['chr_names'], dtype=object)
+
+def peak_arrays_to_frame(arrays, chr_names):
+    """Build a narrowPeak-layout DataFrame from cached arrays"""
+    return pd.DataFrame({
+        'chr': chr_names[arrays['chr_code']],
+        'start': arrays['start'],
+        'end': arrays['end'],
+        'name': arrays['name'].astype(str).astype(object),
+        'score': arrays['score'],
+        'strand': arrays['strand'].astype(str).astype(object),
+        'signalValue': arrays['signalValue'],
+        'pValue': arrays['pValue'],
+        'qValue': arrays['qValue'],
+        'peak': arrays['peak']
+    }, columns=NARROWPEAK_COLUMNS)
+
+def load_peak_arrays(peak_file, fmt='narrowPeak', cache_dir=None):
+    """
+    Memory-mapped typed arrays of a peak file, building the cache on first use.
+
+    The cache lives next to the peak file (or in cache_dir) and is keyed by the
+    file's content hash, so edited or replaced peak files are re-parsed.
+
+    Returns:
+        tuple: (dict of column -> memory-mapped array, chromosome names)
+    """
+    if not os.path.exists(peak_file):
+        raise FileNotFoundError(f"Peak file not found: {peak_file}")
+
+    cache_path = peak_cache_path(peak_file, cache_dir)
+    if os.path.isdir(cache_path):
+        try:
+            return read_peak_arrays(cache_path)
+        except Exception as e:
+            print(f"Warning: could not read peak cache {cache_path}: {str(e)}")
+
+    peaks = PEAK_READERS[fmt](peak_file)
+
+    try:
+        # Drop caches of previous versions of the same peak file
+        prefix = cache_path.rsplit('.peaks.', 1)[0]
+        for old_path in glob.glob(f"{prefix}.peaks.v*"):
+            shutil.rmtree(old_path, ignore_errors=True)
+        save_peak_cache(peaks, cache_path)
+        return read_peak_arrays(cache_path)
+    except OSError as e:
+        print(f"Warning: could not write peak cache {cache_path}: {str(e)}")
+
+    # Cache not writable: fall back to in-memory typed arrays
+    return peak_table_to_arrays(peaks)
+
+def load_peaks(peak_file, fmt='narrowPeak', cache_dir=None, use_cache=True):
+    """
+    Load a peak file as a DataFrame with the narrowPeak columns.
+
+    Args:
+        peak_file: narrowPeak file or SEACR bed
+        fmt: 'narrowPeak' or 'seacr'
+        cache_dir: Directory for the binary cache (default: next to the peak file)
+        use_cache: Set to False to always re-parse the text file
+
+    Returns:
+        pd.DataFrame with columns chr, start, end, name, score, strand,
+        signalValue, pValue, qValue, peak
+    """
+    if not use_cache:
+        return PEAK_READERS[fmt](peak_file)
+    return peak_arrays_to_frame(*load_peak_arrays(peak_file, fmt, cache_dir))
+
+
+######################## Peak set ########################################################################################################################################################################
+class PeakSet:
+    """
+    Intervals (peaks, or any chr/start/end table) partitioned by chromosome.
+
+    Within each chromosome the intervals are sorted by start, with a running
+    maximum of the ends, so overlap queries are two binary searches instead of
+    a boolean scan over the whole table. Query results are positions into the
+    original table, in its original row order.
+    """
+    def __init__(self, peaks):
+        """
+        Parameters:
+        -----------
+        peaks : pd.DataFrame
+            Table with at least chr, start and end columns (closed intervals,
+            matching the `start <= end_q & end >= start_q` tests they replace)
+        """
+        self.peaks = peaks
+        if peaks.empty or not all(col in peaks.columns for col in ['chr', 'start', 'end']):
+            codes, chr_names = np.zeros(0, dtype=np.int64), []
+            starts = ends = np.zeros(0, dtype=np.int64)
+        else:
+            codes, chr_names = pd.factorize(peaks['chr'], sort=True)
+            starts = peaks['start'].to_numpy(dtype=np.int64)
+            ends = peaks['end'].to_numpy(dtype=np.int64)
+
+        # Sort by chromosome, then start; ties keep the original row order
+        self._order = np.lexsort((starts, codes))
+        self._start = starts[self._order]
+        self._end = ends[self._order]
+        self._max_end = self._end.copy()
+
+        sorted_codes = codes[self._order]
+        bounds = np.searchsorted(sorted_codes, np.arange(len(chr_names) + 1))
+        self._bounds = {}
+        for code, chrom in enumerate(chr_names):
+            lo, hi = bounds[code], bounds[code + 1]
+            self._bounds[chrom] = (lo, hi)
+            self._max_end[lo:hi] = np.maximum.accumulate(self._end[lo:hi])
+
+    def __len__(self):
+        return len(self._order)
+
+    @property
+    def empty(self):
+        return len(self._order) == 0
+
+    @property
+    def chromosomes(self):
+        return list(self._bounds)
+
+    def _candidates(self, lo, hi, starts, ends, how):
+        """Sorted-offset ranges [left, right) that can satisfy the query"""
+        if how == 'overlap':
+            # Intervals before `left` all end before the query starts
+            left = np.searchsorted(self._max_end[lo:hi], starts, 'left')
+            right = np.searchsorted(self._start[lo:hi], ends, 'right')
+        elif how == 'within':
+            left = np.searchsorted(self._start[lo:hi], starts, 'left')
+            right = np.searchsorted(self._start[lo:hi], ends, 'right')
+        else:
+            raise ValueError(f"Unknown query type: {how}")
+        return left + lo, np.maximum(right + lo, left + lo)
+
+    def query(self, chrom, start, end, how='overlap'):
+        """
+        Positions of the intervals matching one query region.
+
+        Args:
+            chrom, start, end: Query region
+            how: 'overlap' (start <= end_q and end >= start_q) or
+                 'within' (start >= start_q and end <= end_q)
+
+        Returns:
+            np.ndarray of row positions into self.peaks, in original order
+        """
+        if chrom not in self._bounds:
+            return np.zeros(0, dtype=np.int64)
+        lo, hi = self._bounds[chrom]
+        left, right = self._candidates(lo, hi, start, end, how)
+
+        ends = self._end[left:right]
+        keep = ends >= start if how == 'overlap' else ends <= end
+        return np.sort(self._order[left:right][keep])
+
+    def overlapping(self, chrom, start, end, how='overlap'):
+        """Rows of self.peaks matching one query region (see query)"""
+        return self.peaks.iloc[self.query(chrom, start, end, how)]
+
+    def query_chromosome(self, chrom, starts, ends, how='overlap'):
+        """
+        Batched query for many regions on one chromosome.
+
+        Returns:
+            tuple: (query_idx, positions) int64 arrays of matching pairs, unsorted
+        """
+        if chrom not in self._bounds:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        lo, hi = self._bounds[chrom]
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        left, right = self._candidates(lo, hi, starts, ends, how)
+
+        # Expand every [left, right) range into candidate offsets
+        counts = right - left
+        query_idx = np.repeat(np.arange(len(starts)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(left, counts)
+
+        if how == 'overlap':
+            keep = self._end[offsets] >= starts[query_idx]
+        else:
+            keep = self._end[offsets] <= ends[query_idx]
+        return query_idx[keep], self._order[offsets[keep]]
+
+    def query_many(self, chroms, starts, ends, how='overlap'):
+        """
+        Batched query for many regions at once.
+
+        Returns:
+            tuple: (query_idx, positions) int64 arrays of matching pairs, sorted by
+            query and then by original row order
+        """
+        chroms = np.asarray(chroms, dtype=object)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+
+        query_parts, position_parts = [], []
+        for chrom in self._bounds:
+            queries = np.flatnonzero(chroms == chrom)
+            if not len(queries):
+                continue
+            query_idx, positions = self.query_chromosome(chrom, starts[queries], ends[queries], how)
+            query_parts.append(queries[query_idx])
+            position_parts.append(positions)
+
+        if not query_parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        query_idx = np.concatenate(query_parts)
+        positions = np.concatenate(position_parts)
+        order = np.lexsort((positions, query_idx))
+        return query_idx[order], positions[order]
+
+def as_peak_set(peaks):
+    """Return peaks as a PeakSet (built from a DataFrame if needed)"""
+    return peaks if isinstance(peaks, PeakSet) else PeakSet(peaks)
+
+def build_peak_sets(peaks_dict):
+    """PeakSet per sample of a {sample: peaks DataFrame} dict"""
+    return {sample: as_peak_set(peaks) for sample, peaks in peaks_dict.items()}
+
+
+######################## Replicate consolidation ########################################################################################################################################################################
+def consolidate_replicates(peaks_dict, max_gap=0, min_replicates=1, signal='sum'):
+    """
+    Merge the overlapping or nearby peaks of several replicates into consensus intervals.
+
+    One sort by chromosome and start, then a sweep-line pass: a peak opens a
+    new interval when it starts more than max_gap bp after the furthest end
+    seen so far on its chromosome (max_gap=0 merges overlapping and
+    book-ended peaks, as bedtools merge). Aggregates are reduceat calls over
+    the sorted columns.
+
+    Args:
+        peaks_dict: {replicate: peaks DataFrame with chr, start, end,
+                    signalValue and qValue columns} (at most 63 replicates)
+        max_gap: Largest distance (bp) between peaks merged into one interval
+        min_replicates: Keep intervals supported by at least this many replicates
+        signal: 'sum' or 'mean' of the merged signalValues (NaN ignored)
+
+    Returns:
+        pd.DataFrame with chr, start, end, signalValue, qValue (min), n_peaks,
+        n_replicates and replicates (';'-joined names), sorted by chr and start
+    """
+    if signal not in ('sum', 'mean'):
+        raise ValueError(f"Unknown signal aggregate: {signal}")
+    names = list(peaks_dict)
+    if len(names) > 63:
+        raise ValueError(f"At most 63 replicates can be consolidated, got {len(names)}")
+    columns = ['chr', 'start', 'end', 'signalValue', 'qValue', 'n_peaks', 'n_replicates', 'replicates']
+    frames = [peaks_dict[name][['chr', 'start', 'end', 'signalValue', 'qValue']] for name in names]
+    sizes = [len(frame) for frame in frames]
+    if not sum(sizes):
+        return pd.DataFrame(columns=columns)
+    peaks = pd.concat(frames, ignore_index=True)
+    replicate = np.repeat(np.arange(len(names), dtype=np.int64), sizes)
+
+    codes, chr_names = pd.factorize(peaks['chr'], sort=True)
+    starts = peaks['start'].to_numpy(dtype=np.int64)
+    ends = peaks['end'].to_numpy(dtype=np.int64)
+    order = np.lexsort((ends, starts, codes))
+    codes, starts, ends, replicate = codes[order], starts[order], ends[order], replicate[order]
+
+    # Offset every chromosome past the previous one, so one running maximum
+    # covers the whole table and a new chromosome always opens an interval
+    span = int(ends.max()) + max_gap + 1
+    offset = codes.astype(np.int64) * span
+    furthest_end = np.maximum.accumulate(ends + offset)
+    opens = np.ones(len(starts), dtype=bool)
+    opens[1:] = starts[1:] + offset[1:] > furthest_end[:-1] + max_gap
+    first = np.flatnonzero(opens)
+
+    signal_values = peaks['signalValue'].to_numpy(dtype=np.float64)[order]
+    has_signal = ~np.isnan(signal_values)
+    signal_sum = np.add.reduceat(np.where(has_signal, signal_values, 0), first)
+    if signal == 'mean':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            signal_sum = signal_sum / np.add.reduceat(has_signal.astype(np.int64), first)
+
+    # Supporting replicates as a bit mask per interval, labelled once per distinct mask
+    masks = np.bitwise_or.reduceat(np.left_shift(1, replicate), first)
+    distinct, mask_idx = np.unique(masks, return_inverse=True)
+    labels = [[name for bit, name in enumerate(names) if mask >> bit & 1] for mask in distinct.tolist()]
+    n_replicates = np.array([len(label) for label in labels], dtype=np.int64)[mask_idx]
+
+    merged = pd.DataFrame({
+        'chr': np.asarray(chr_names, dtype=object)[codes[first]],
+        'start': starts[first],
+        'end': np.maximum.reduceat(ends, first),
+        'signalValue': signal_sum,
+        'qValue': np.fmin.reduceat(peaks['qValue'].to_numpy(dtype=np.float64)[order], first),
+        'n_peaks': np.diff(np.append(first, len(starts))),
+        'n_replicates': n_replicates,
+        'replicates': np.array([';'.join(label) for label in labels], dtype=object)[mask_idx]
+    })
+    return merged[merged['n_replicates'] >= min_replicates].reset_index(drop=True)
+
+
+######################## Region x peak join ########################################################################################################################################################################
+def gene_peak_join(chroms, starts, ends, peak_sets, keys=None):
+    """
+    Overlaps between many regions and the peaks of every sample, in one pass.
+
+    Args:
+        chroms, starts, ends: Query regions (e.g. gene promoters)
+        peak_sets: {sample: PeakSet or peaks DataFrame}
+        keys: Label of each region (default: its position)
+
+    Returns:
+        pd.DataFrame in long format with columns gene (region key), sample and
+        peak (row position in that sample's peaks), ordered by region, then
+        sample (dict order), then peak row
+    """
+    keys = np.arange(len(chroms)) if keys is None else np.asarray(keys)
+
+    parts = []
+    for sample, peaks in peak_sets.items():
+        query_idx, positions = as_peak_set(peaks).query_many(chroms, starts, ends)
+        parts.append(pd.DataFrame({'query': query_idx, 'sample': sample, 'peak': positions}))
+    if not parts:
+        return pd.DataFrame({'gene': keys[:0], 'sample': [], 'peak': np.zeros(0, dtype=np.int64)})
+
+    join = pd.concat(parts, ignore_index=True).sort_values('query', kind='stable')
+    join.insert(0, 'gene', keys[join['query'].to_numpy()])
+    return join.drop(columns='query').reset_index(drop=True)
+
+def region_signal(chroms, starts, ends, peak_sets, half_open=False, max_workers=1):
+    """
+    Summed signalValue of the peaks overlapping each region, over all samples.
+
+    One gene_peak_join of all regions, then a grouped sum by region, instead of
+    matching every region against per-sample overlap tables. With several
+    workers the regions are summed per chromosome in worker processes that
+    share the coordinate and signal columns (shared_region_signal).
+
+    Args:
+        chroms, starts, ends: Regions (e.g. CpG islands)
+        peak_sets: {sample: PeakSet or peaks DataFrame}
+        half_open: Use BED overlap rules (start < end_q and end > start_q, as
+                   bedtools intersect) instead of closed intervals
+        max_workers: Worker processes (1 runs the join in this process)
+
+    Returns:
+        np.ndarray (float64) with one sum per region; NaN signals count as 0
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if half_open:
+        # p.start < e and p.end > s  <=>  p.start <= e - 1 and p.end >= s + 1
+        starts, ends = starts + 1, ends - 1
+    if max_workers != 1:
+        return shared_region_signal(chroms, starts, ends, peak_sets, max_workers)
+
+    join = gene_peak_join(np.asarray(chroms, dtype=object), starts, ends, peak_sets)
+    signal = np.zeros(len(join))
+    for sample, peaks in peak_sets.items():
+        selected = (join['sample'] == sample).to_numpy()
+        if selected.any():
+            values = as_peak_set(peaks).peaks['signalValue'].to_numpy(dtype=np.float64)
+            signal[selected] = values[join['peak'].to_numpy()[selected]]
+    return np.bincount(join['gene'].to_numpy(dtype=np.int64), weights=np.nan_to_num(signal),
+                       minlength=len(starts))
+
+def region_peak_totals(chroms, starts, ends, peak_sets, how='overlap'):
+    """
+    Number of matching peaks and their summed signalValue per region, over all samples.
+
+    One batched PeakSet query per sample, reduced by region with bincount.
+
+    Args:
+        chroms, starts, ends: Regions (e.g. gene bodies +/- a flank)
+        peak_sets: {sample: PeakSet or peaks DataFrame}
+        how: 'overlap' or 'within' (see PeakSet.query)
+
+    Returns:
+        tuple: (counts, signal) arrays with one entry per region; NaN signals
+        count as 0
+    """
+    chroms = np.asarray(chroms, dtype=object)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    counts = np.zeros(len(starts), dtype=np.int64)
+    signal = np.zeros(len(starts))
+    for peaks in peak_sets.values():
+        peak_set = as_peak_set(peaks)
+        if peak_set.empty:
+            continue
+        query_idx, positions = peak_set.query_many(chroms, starts, ends, how)
+        values = np.nan_to_num(peak_set.peaks['signalValue'].to_numpy(dtype=np.float64)[positions])
+        counts += np.bincount(query_idx, minlength=len(starts))
+        signal += np.bincount(query_idx, weights=values, minlength=len(starts))
+    return counts, signal
+
+def regions_to_genes(regions, annotation_index, flank=0):
+    """
+    Genes within flank bp of every region, from one sorted-interval join.
+
+    Regions and gene bodies are closed intervals (as GTF coordinates); a gene
+    is reported when its body overlaps the region extended by flank on both
+    sides, i.e. when their distance is at most flank.
+
+    Args:
+        regions: DataFrame with chr, start and end columns (e.g. peaks or
+                 CpG islands)
+        annotation_index: GeneIndex of the annotation
+        flank: Largest distance (bp) between region and gene body
+
+    Returns:
+        pd.DataFrame in long format with columns region (row position in
+        regions), gene (gene row), gene_name and distance (bp, 0 when the
+        gene overlaps the region), ordered by region, then gene row
+    """
+    genes = PeakSet(pd.DataFrame({
+        'chr': annotation_index.chromosomes(np.arange(annotation_index.n_genes)),
+        'start': annotation_index.start,
+        'end': annotation_index.end
+    }))
+    starts = regions['start'].to_numpy(dtype=np.int64)
+    ends = regions['end'].to_numpy(dtype=np.int64)
+    region_idx, gene_rows = genes.query_many(regions['chr'].to_numpy(dtype=object), starts - flank, ends + flank)
+
+    distance = np.maximum(np.maximum(annotation_index.start[gene_rows] - ends[region_idx],
+                                     starts[region_idx] - annotation_index.end[gene_rows]), 0)
+    return pd.DataFrame({
+        'region': region_idx,
+        'gene': gene_rows,
+        'gene_name': annotation_index.gene_name[gene_rows],
+        'distance': distance
+    })
+
+def _region_signal_task(columns, chunk):
+    """Signal sums of one chromosome range of the shared, chromosome-sorted regions"""
+    code, lo, hi = chunk
+    peak_lo, peak_hi = columns['peak_bounds'][code], columns['peak_bounds'][code + 1]
+    if peak_lo == peak_hi:
+        return np.zeros(hi - lo)
+    peaks = PeakSet(pd.DataFrame({'chr': 0, 'start': columns['peak_start'][peak_lo:peak_hi],
+                                  'end': columns['peak_end'][peak_lo:peak_hi]}))
+    query_idx, positions = peaks.query_chromosome(0, columns['region_start'][lo:hi],
+                                                  columns['region_end'][lo:hi])
+    return np.bincount(query_idx, weights=columns['peak_signal'][peak_lo:peak_hi][positions],
+                       minlength=hi - lo)
+
+def shared_region_signal(chroms, starts, ends, peak_sets, max_workers=None, max_regions=REGION_TASK_ROWS):
+    """
+    region_signal (closed intervals) computed per chromosome in worker processes.
+
+    The peaks of all samples are pooled, regions and peaks are sorted by
+    chromosome and start, and their columns are placed in shared memory once
+    (SharedColumns); each task sums the regions of one chromosome range
+    against that chromosome's peaks, so workers only receive row ranges.
+
+    Args:
+        chroms, starts, ends, peak_sets: As for region_signal
+        max_workers: Worker processes (default: one per CPU)
+        max_regions: Largest number of regions per task
+
+    Returns:
+        np.ndarray (float64) with one sum per region, as region_signal
+    """
+    from functions_Parallel import SharedColumns, chromosome_bounds, chromosome_chunks, map_shared
+
+    chroms = np.asarray(chroms, dtype=object)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    signal = np.zeros(len(starts))
+    frames = [as_peak_set(peaks).peaks for peaks in peak_sets.values()]
+    frames = [frame[['chr', 'start', 'end', 'signalValue']] for frame in frames if not frame.empty]
+    if not frames or not len(starts):
+        return signal
+    peaks = pd.concat(frames, ignore_index=True)
+
+    # Shared chromosome codes of regions and peaks
+    peak_chroms = peaks['chr'].to_numpy(dtype=object)
+    chr_names = pd.Index(pd.unique(np.concatenate([chroms, peak_chroms])))
+    region_codes = chr_names.get_indexer(chroms)
+    peak_codes = chr_names.get_indexer(peak_chroms)
+    peak_starts = peaks['start'].to_numpy(dtype=np.int64)
+
+    region_order = np.lexsort((starts, region_codes))
+    peak_order = np.lexsort((peak_starts, peak_codes))
+    columns = {
+        'region_start': starts[region_order],
+        'region_end': ends[region_order],
+        'peak_start': peak_starts[peak_order],
+        'peak_end': peaks['end'].to_numpy(dtype=np.int64)[peak_order],
+        'peak_signal': np.nan_to_num(peaks['signalValue'].to_numpy(dtype=np.float64))[peak_order],
+        'peak_bounds': chromosome_bounds(peak_codes[peak_order], len(chr_names))
+    }
+    chunks = chromosome_chunks(chromosome_bounds(region_codes[region_order], len(chr_names)), max_regions)
+
+    with SharedColumns(columns) as shared:
+        sums = map_shared(_region_signal_task, shared, chunks, max_workers, desc='Region signal')
+    for (_, lo, hi), chunk_sums in sums.items():
+        signal[region_order[lo:hi]] = chunk_sums
+    return signal
+
+def joined_peaks(join, peak_sets):
+    """
+    Peak rows referenced by a gene_peak_join table, in join order.
+
+    Returns:
+        pd.DataFrame with the peak columns plus sample and gene
+    """
+    frames = []
+    for sample, peaks in peak_sets.items():
+        selected = join[join['sample'] == sample]
+        if selected.empty:
+            continue
+        rows = as_peak_set(peaks).peaks.iloc[selected['peak'].to_numpy()].copy()
+        rows['sample'] = sample
+        rows['gene'] = selected['gene'].to_numpy()
+        rows.index = selected.index
+        frames.append(rows)
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames).sort_index()
+
+def promoter_join(gene_index, rows, peak_sets, window):
+    """
+    gene_peak_join of the promoters (TSS +/- window) of many genes.
+
+    Args:
+        gene_index: GeneIndex of the annotation
+        rows: Gene rows (GeneIndex.lookup_many), -1 entries and duplicates are ignored
+        peak_sets: {sample: PeakSet or peaks DataFrame}
+        window: Promoter half-width around the TSS
+
+    Returns:
+        pd.DataFrame with gene (gene row), sample and peak columns
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    rows = np.unique(rows[rows >= 0])
+    promoter_starts, promoter_ends = gene_index.promoters.window(window)
+    return gene_peak_join(gene_index.chromosomes(rows), promoter_starts[rows], promoter_ends[rows],
+                          peak_sets, keys=rows)
+
+def promoter_peaks(gene_index, rows, peak_sets, window, prepare=None):
+    """
+    Long gene-peak table of the peaks overlapping the promoters of many genes.
+
+    Args:
+        gene_index, rows, peak_sets, window: As for promoter_join
+        prepare: Optional function applied to the joined peak table (e.g.
+                 signal clean-up)
+
+    Returns:
+        pd.DataFrame: peak columns plus sample and gene (gene row), ordered by
+        gene, then sample, then peak row
+    """
+    peaks = joined_peaks(promoter_join(gene_index, rows, peak_sets, window), peak_sets)
+    if prepare is not None and not peaks.empty:
+        peaks = prepare(peaks)
+    return peaks
+
+def tss_distances(gene_index, peaks):
+    """
+    Distance (bp) between each peak of a long gene-peak table and its gene's TSS.
+
+    0 for peaks covering the TSS. A peak overlaps the TSS +/- w promoter exactly
+    when its distance is <= w, so smaller windows are thresholds on this column.
+    """
+    tss = gene_index.promoters.tss[peaks['gene'].to_numpy(dtype=np.int64)]
+    starts = peaks['start'].to_numpy(dtype=np.int64)
+    ends = peaks['end'].to_numpy(dtype=np.int64)
+    return np.maximum(np.maximum(starts - tss, tss - ends), 0)
+
+def promoter_sweep_peaks(gene_index, rows, peak_sets, windows, prepare=None):
+    """
+    promoter_peaks at the largest of several windows, with a tss_distance column.
+
+    Returns:
+        pd.DataFrame as promoter_peaks; rows with tss_distance <= w are exactly
+        promoter_peaks at window w, in the same order
+    """
+    peaks = promoter_peaks(gene_index, rows, peak_sets, max(windows), prepare)
+    if not peaks.empty:
+        peaks['tss_distance'] = tss_distances(gene_index, peaks)
+    return peaks
+
+def split_by_gene(peaks):
+    """Split a long gene-peak table into {gene: peaks DataFrame} (gene column dropped)"""
+    if peaks.empty:
+        return {}
+    return {gene: gene_peaks.drop(columns='gene').reset_index(drop=True)
+            for gene, gene_peaks in peaks.groupby('gene', sort=False)}
+
+def peak_coordinates(peaks):
+    """'chr:start-end' label of every row of a peak table, built column-wise"""
+    return peaks['chr'].astype(str) + ':' + peaks['start'].astype(str) + '-' + peaks['end'].astype(str)
+
+def gene_peak_coordinates(peaks):
+    """
+    ';'-joined peak labels of each gene of a long gene-peak table.
+
+    Returns:
+        pd.Series indexed by gene, labels in table order (promoter_peaks order)
+    """
+    if peaks.empty:
+        return pd.Series(dtype=object)
+    return peak_coordinates(peaks).groupby(peaks['gene'].to_numpy(), sort=False).agg(';'.join)
+
+def gene_peak_membership(peaks_by_condition, gene_names):
+    """
+    Long gene-peak table of several conditions, one row per gene and peak.
+
+    Args:
+        peaks_by_condition: {condition: long gene-peak table (promoter_peaks)}
+        gene_names: Gene name of each gene row (GeneIndex.gene_name)
+
+    Returns:
+        pd.DataFrame with gene, condition, sample, chr, start and end columns
+    """
+    columns = ['gene', 'condition', 'sample', 'chr', 'start', 'end']
+    frames = []
+    for condition, peaks in peaks_by_condition.items():
+        if peaks.empty:
+            continue
+        frame = peaks[['sample', 'chr', 'start', 'end']].copy()
+        frame.insert(0, 'condition', condition)
+        frame.insert(0, 'gene', gene_names[peaks['gene'].to_numpy(dtype=np.int64)])
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)[columns]
+
+def with_peak_coordinates(table, exo_coordinates=None, endo_coordinates=None):
+    """
+    Export view of a per-method enrichment table.
+
+    Adds exo_peaks/endo_peaks label columns (gene_peak_coordinates, looked up
+    by the gene_row column; 'None' for genes without peaks) before the peak
+    counts, and drops gene_row. Without coordinates only gene_row is dropped.
+    """
+    rows = table['gene_row']
+    table = table.drop(columns='gene_row')
+    if exo_coordinates is None or endo_coordinates is None:
+        return table
+
+    position = table.columns.get_loc('num_exo_peaks') if 'num_exo_peaks' in table else len(table.columns)
+    for offset, (column, coordinates) in enumerate([('exo_peaks', exo_coordinates),
+                                                    ('endo_peaks', endo_coordinates)]):
+        labels = coordinates.reindex(rows.to_numpy()).fillna('None').to_numpy()
+        table.insert(position + offset, column, labels)
+    return table
+
+
+######################## Sample loading ########################################################################################################################################################################
+def _timed_call(func, sample):
+    """Run func(sample), return (result, elapsed seconds)"""
+    start = time.perf_counter()
+    result = func(sample)
+    return result, time.perf_counter() - start
+
+def load_samples(samples, load_sample, max_workers=None, use_processes=False):
+    """
+    Load several samples concurrently and log per-sample timings.
+
+    Peak parsing and BAM depth counting are I/O bound (pysam releases the GIL
+    while reading), so a thread pool is the default; use_processes=True runs
+    load_sample in worker processes instead (it must then be picklable, i.e.
+    a module-level function).
+
+    Args:
+        samples: Sample names
+        load_sample: Function called as load_sample(sample)
+        max_workers: Pool size (default: one worker per sample)
+        use_processes: Use a process pool instead of threads
+
+    Returns:
+        dict: sample -> load_sample(sample), in the order of samples
+    """
+    samples = list(samples)
+    max_workers = max(1, min(max_workers or len(samples), len(samples)))
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+
+    start = time.perf_counter()
+    with executor_class(max_workers=max_workers) as executor:
+        timed = list(executor.map(partial(_timed_call, load_sample), samples))
+    wall = time.perf_counter() - start
+
+    for sample, (_, elapsed) in zip(samples, timed):
+        print(f"Loaded {sample} in {elapsed:.1f}s")
+    print(f"Loaded {len(samples)} samples in {wall:.1f}s with {max_workers} workers "
+          f"(sum of sample times {sum(elapsed for _, elapsed in timed):.1f}s)")
+
+    return {sample: result for sample, (result, _) in zip(samples, timed)}
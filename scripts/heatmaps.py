@@ -3,6 +3,8 @@ import pandas as pd
 import subprocess
 from pathlib import Path
 
+from functions_Annotation import load_gene_table
+
 class CutAndTagHeatmap:
     def __init__(self, output_dir, window_size=5000, bin_size=50):
         """
@@ -56,24 +58,19 @@ class CutAndTagHeatmap:
         """
         tss_file = self.output_dir / "tss_regions.bed"
         
-        # Read GTF file and extract TSS regions
-        df = pd.read_csv(genome_gtf, sep='\t', comment='#', header=None,
-                        names=['chrom', 'source', 'feature', 'start', 'end', 
-                              'score', 'strand', 'frame', 'attributes'])
-        
-        # Filter for genes
-        genes = df[df['feature'] == 'gene']
+        # Gene records of the GTF (cached next to the GTF after the first parse)
+        genes = load_gene_table(genome_gtf)
         
         # Extract TSS based on strand
-        tss = genes.copy()
+        tss = genes.rename(columns={'chr': 'chrom', 'gene_name': 'name'})
         tss.loc[tss['strand'] == '+', 'end'] = tss['start']  # Forward strand TSS
         tss.loc[tss['strand'] == '-', 'start'] = tss['end']  # Reverse strand TSS
         
         # Create 1bp TSS regions and extend by 1bp (required for deepTools)
         tss['start'] = tss['start'] - 1
         
-        # Extract gene names from attributes
-        tss['name'] = tss['attributes'].str.extract('gene_name "([^"]+)"')
+        # GTF score column is '.' for gene records
+        tss['score'] = '.'
         
         # Select and order columns for BED format
         tss_bed = tss[['chrom', 'start', 'end', 'name', 'score', 'strand']]
@@ -0,0 +1,179 @@
+# Standard library imports
+import ast
+import re
+from pathlib import Path
+
+# Third party imports
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+import functions_Enrichment
+from functions_Annotation import GeneIndex
+from functions_Enrichment import (ENRICHMENT_METHODS, permutation_pvalues, score_enrichment, score_promoters,
+                                  verify_enrichment_scores)
+from functions_Peaks import build_peak_sets, promoter_peaks, split_by_gene
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+ENRICHMENT_SCRIPTS = sorted(path.name for path in SCRIPTS_DIR.glob('analyze_enrichment_*.py'))
+WINDOW = 1000
+
+
+######################## Synthetic data ########################################################################################################################################################################
+def peak(chrom, start, end, signal, qvalue):
+    return {'chr': chrom, 'start': start, 'end': end, 'signalValue': signal, 'qValue': qvalue}
+
+def make_genes():
+    """Genes as (chr, TSS, strand); chr3 holds a block of randomly placed genes"""
+    genes = [
+        ('chr1', 10_000, '+'),   # peaks on both sides
+        ('chr1', 20_000, '-'),   # exo only
+        ('chr1', 30_000, '+'),   # endo only
+        ('chr1', 40_000, '+'),   # duplicate intervals across and within samples
+        ('chr1', 50_000, '-'),   # shares an exo peak with the next gene
+        ('chr1', 50_500, '+'),
+        ('chr1', 70_000, '+'),   # identical exo and endo peaks (ties)
+        ('chr2', 10_000, '+'),   # peaks touching the promoter ends
+        ('chr2', 20_000, '-'),   # extreme q-values
+        ('chr2', 30_000, '+'),   # no peaks at all
+    ]
+    genes += [('chr3', 10_000 * (i + 1), '+-'[i % 2]) for i in range(30)]
+    table = pd.DataFrame(genes, columns=['chr', 'tss', 'strand'])
+    table['start'] = np.where(table['strand'] == '+', table['tss'], table['tss'] - 3000)
+    table['end'] = np.where(table['strand'] == '+', table['tss'] + 3000, table['tss'])
+    table['gene_name'] = [f'GENE{i}' for i in range(len(table))]
+    table['gene_name_std'] = table['gene_name']
+    table['gene_id_std'] = [f'ENSG{i:011d}' for i in range(len(table))]
+    return table.drop(columns='tss')
+
+def make_peaks():
+    """{sample: peaks} of two exo and two endo samples around the genes of make_genes"""
+    exo = {'A': [
+        peak('chr1', 9_800, 10_100, 5.0, 1e-3),
+        peak('chr1', 19_500, 19_900, 3.0, 1e-5),
+        peak('chr1', 20_100, 20_600, 4.0, 1e-2),
+        peak('chr1', 39_900, 40_300, 7.0, 1e-4),
+        peak('chr1', 39_900, 40_300, 2.0, 1e-6),
+        peak('chr1', 50_200, 50_400, 3.5, 1e-8),
+        peak('chr1', 69_900, 70_200, 4.0, 1e-3),
+        peak('chr2', 8_000, 9_000, 1.5, 1e-2),
+    ], 'B': [
+        peak('chr1', 9_900, 10_300, 8.0, 1e-70),
+        peak('chr1', 39_900, 40_300, 6.0, 1e-4),
+        peak('chr2', 19_800, 20_100, 9.0, 0.0),
+    ]}
+    endo = {'C': [
+        peak('chr1', 9_950, 10_050, 2.0, 0.5),
+        peak('chr1', 29_800, 30_200, 6.0, 1e-4),
+        peak('chr1', 40_000, 40_100, 3.0, 1e-3),
+        peak('chr1', 69_900, 70_200, 4.0, 1e-3),
+        peak('chr2', 10_900, 11_500, 2.5, 1e-2),
+    ], 'D': [
+        peak('chr1', 30_500, 30_800, 0.5, 1.0),
+        peak('chr1', 40_000, 40_100, 3.0, 1e-3),
+        peak('chr1', 49_500, 49_700, 0.2, 0.9),
+        peak('chr2', 19_000, 19_300, 1.0, 1e-12),
+    ]}
+
+    # Random peaks on chr3, some intervals reused across samples and conditions
+    rng = np.random.default_rng(0)
+    centers = 10_000 * rng.integers(1, 31, size=60) + rng.integers(-1500, 1500, size=60)
+    widths = rng.integers(100, 800, size=60)
+    for i, sample in enumerate(rng.choice(['A', 'B', 'C', 'D'], size=90)):
+        j = i % 60
+        side = exo if sample in exo else endo
+        side[sample].append(peak('chr3', int(centers[j]), int(centers[j] + widths[j]),
+                                 float(rng.choice([1.0, 2.5, rng.uniform(0.1, 20)])),
+                                 float(10.0 ** -rng.uniform(0, 80))))
+
+    def frames(side):
+        return {sample: pd.DataFrame(rows) for sample, rows in side.items()}
+    return frames(exo), frames(endo)
+
+@pytest.fixture(scope='module')
+def data():
+    gene_index = GeneIndex(make_genes())
+    peaks_exo, peaks_endo = make_peaks()
+    total_genome_peaks = sum(len(peaks) for peaks in [*peaks_exo.values(), *peaks_endo.values()])
+    return {'gene_index': gene_index, 'rows': np.arange(gene_index.n_genes),
+            'peaks_exo': peaks_exo, 'peaks_endo': peaks_endo,
+            'exo': build_peak_sets(peaks_exo), 'endo': build_peak_sets(peaks_endo),
+            'total_genome_peaks': total_genome_peaks}
+
+
+######################## Script lambdas ########################################################################################################################################################################
+def load_script_methods(script):
+    """
+    define_enrichment_methods and the q-value weight of an analysis script.
+
+    Importing a script needs its plotting and bedtools dependencies, so only
+    the function definition is compiled.
+    """
+    source = (SCRIPTS_DIR / script).read_text()
+    tree = ast.parse(source)
+    function = next(node for node in tree.body
+                    if isinstance(node, ast.FunctionDef) and node.name == 'define_enrichment_methods')
+    namespace = {'np': np, 'pd': pd, 'stats': stats}
+    exec(compile(ast.Module(body=[function], type_ignores=[]), script, 'exec'), namespace)
+    weight = re.search(r'qvalue_weight=(neg_log10_qvalue_\w+)', source).group(1)
+    return namespace['define_enrichment_methods'], getattr(functions_Enrichment, weight)
+
+
+######################## Tests ########################################################################################################################################################################
+@pytest.mark.parametrize('script', ENRICHMENT_SCRIPTS)
+def test_score_enrichment_matches_lambdas(data, script):
+    define_enrichment_methods, qvalue_weight = load_script_methods(script)
+    methods = define_enrichment_methods(data['total_genome_peaks'])
+    assert list(methods) == ENRICHMENT_METHODS
+
+    exo_peaks = promoter_peaks(data['gene_index'], data['rows'], data['exo'], WINDOW)
+    endo_peaks = promoter_peaks(data['gene_index'], data['rows'], data['endo'], WINDOW)
+    scores = score_enrichment(exo_peaks, endo_peaks, data['total_genome_peaks'], qvalue_weight)
+    exo_by_gene, endo_by_gene = split_by_gene(exo_peaks), split_by_gene(endo_peaks)
+
+    # Every gene with a peak on either side is scored, including one-sided genes
+    assert set(scores.index) == set(exo_by_gene) | set(endo_by_gene)
+    assert set(exo_by_gene) - set(endo_by_gene) and set(endo_by_gene) - set(exo_by_gene)
+    assert 9 not in scores.index
+
+    for gene in scores.index:
+        exo = exo_by_gene.get(gene, pd.DataFrame())
+        endo = endo_by_gene.get(gene, pd.DataFrame())
+        for method_name, method_func in methods.items():
+            try:
+                with np.errstate(divide='ignore'):
+                    expected = float(method_func(exo, endo))
+            except Exception:
+                expected = np.nan
+            np.testing.assert_allclose(scores.at[gene, method_name], expected, rtol=1e-8, atol=0,
+                                       err_msg=f'{script}: gene {gene}, {method_name}')
+
+    with np.errstate(divide='ignore'):
+        assert verify_enrichment_scores(scores, exo_by_gene, endo_by_gene, methods).empty
+
+def test_score_promoters_workers_match_serial(data):
+    args = (data['gene_index'], data['rows'], data['exo'], data['endo'], WINDOW, data['total_genome_peaks'])
+    serial = score_promoters(*args, max_workers=1, chunk_size=4)
+    parallel = score_promoters(*args, max_workers=2, chunk_size=4)
+    for serial_table, parallel_table in zip(serial, parallel):
+        pd.testing.assert_frame_equal(serial_table, parallel_table)
+
+    # Same table as the unchunked join + columnar scoring
+    exo_peaks = promoter_peaks(data['gene_index'], data['rows'], data['exo'], WINDOW)
+    endo_peaks = promoter_peaks(data['gene_index'], data['rows'], data['endo'], WINDOW)
+    pd.testing.assert_frame_equal(serial[0], score_enrichment(exo_peaks, endo_peaks, data['total_genome_peaks']),
+                                  check_index_type=False)
+    pd.testing.assert_frame_equal(serial[1].reset_index(drop=True), exo_peaks.reset_index(drop=True))
+    pd.testing.assert_frame_equal(serial[2].reset_index(drop=True), endo_peaks.reset_index(drop=True))
+
+def test_permutation_pvalues_workers_match_serial(data):
+    scores = score_promoters(data['gene_index'], data['rows'], data['exo'], data['endo'], WINDOW,
+                             data['total_genome_peaks'])[0]
+    args = (scores, data['peaks_exo'], data['peaks_endo'], data['gene_index'], WINDOW, data['total_genome_peaks'])
+    serial = permutation_pvalues(*args, n_permutations=120, seed=1, max_workers=1)
+    parallel = permutation_pvalues(*args, n_permutations=120, seed=1, max_workers=2)
+    pd.testing.assert_frame_equal(serial, parallel)
+    pvalues = serial.to_numpy()[serial.notna().to_numpy()]
+    assert ((pvalues > 0) & (pvalues <= 1)).all()
+    assert serial.isna().equals(scores[ENRICHMENT_METHODS].isna())
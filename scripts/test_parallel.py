@@ -0,0 +1,31 @@
+# Standard library imports
+import multiprocessing as mp
+
+# Third party imports
+import numpy as np
+import pytest
+
+from functions_Parallel import SharedColumns, chromosome_bounds, chromosome_chunks, map_shared
+
+
+def _weighted_sum(columns, chunk):
+    """Sum of value * weight over one chunk (module level, so spawned workers can import it)"""
+    _, lo, hi = chunk
+    return float(np.sum(columns['value'][lo:hi] * columns['weight'][lo:hi]))
+
+@pytest.fixture(scope='module')
+def columns():
+    rng = np.random.default_rng(0)
+    codes = np.sort(rng.integers(0, 4, size=1000))
+    return {'code': codes, 'value': rng.random(1000), 'weight': rng.integers(1, 5, size=1000)}
+
+@pytest.mark.parametrize('method', [method for method in ('spawn', 'forkserver')
+                                    if method in mp.get_all_start_methods()])
+def test_map_shared_non_fork_context(columns, method):
+    chunks = chromosome_chunks(chromosome_bounds(columns['code'], 4), max_rows=100)
+    with SharedColumns(columns) as shared:
+        serial = map_shared(_weighted_sum, shared, chunks, max_workers=1)
+        parallel = map_shared(_weighted_sum, shared, chunks, max_workers=2, mp_context=mp.get_context(method))
+    assert list(parallel) == chunks
+    assert parallel == pytest.approx(serial)
+    assert sum(parallel.values()) == pytest.approx(float(np.sum(columns['value'] * columns['weight'])))